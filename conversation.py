@@ -0,0 +1,312 @@
+import sys
+import json
+import asyncio
+import time
+from collections import deque, OrderedDict
+from datetime import datetime
+from typing import Awaitable, Callable, Optional, Union
+
+import discord
+
+from memorydb import AsyncDatabaseManager
+from prompting import estimate_tokens
+
+history_maxcount: int = 30
+TIMESTAMP_FORMAT = "%Y/%m/%d %a. %H:%M"
+TIMEZONE_OFFSET = 8 * 3600  # 顯示為台灣時間
+RECORD_OVERHEAD = 200  # 每則紀錄除了內容字串以外的估計位元組數（物件、deque 與 msg_id 集合）
+# 這次執行中已向 Discord 補抓過的頻道；之後 on_message 會記錄每一則訊息，本地紀錄已是最新
+caught_up_channels: set[int] = set()
+
+
+class HistoryRecord:
+    """一則對話紀錄；時間以 epoch 秒保存，需要顯示時才格式化"""
+    __slots__ = ('msg_id', 'author_id', 'name', 'content', 'created_at')
+
+    def __init__(self, msg_id: int, author_id: int, name: str, content: str,
+                 created_at: Union[datetime, float, str, None] = None) -> None:
+        self.msg_id = msg_id
+        self.author_id = author_id
+        self.name = sys.intern(name)  # 同一位使用者的名稱只存一份
+        self.content = content
+        if isinstance(created_at, datetime):
+            created_at = created_at.timestamp()
+        self.created_at = time.time() if created_at is None else created_at
+
+    @property
+    def timestamp(self) -> str:
+        if isinstance(self.created_at, str):  # 舊格式：已格式化的字串
+            return self.created_at
+        return time.strftime(TIMESTAMP_FORMAT, time.gmtime(self.created_at + TIMEZONE_OFFSET))
+
+    def __repr__(self) -> str:
+        return f"{self.timestamp} id={self.author_id} name={self.name}: {self.content}"
+
+
+class conversation:
+    def __init__(self, max_count: int = history_maxcount):
+        self.history: deque[HistoryRecord] = deque(maxlen=int(max_count))  # 固定容量，舊的自動移除
+        self._msg_ids: set[int] = set()  # 與 history 同步，O(1) 判斷是否重複
+        self.users_id: dict[int, int] = {}  # id:剩餘次數
+        self.channels_id: dict[int, int] = {}
+        self.servers_id: dict[int, int] = {}
+        self.long_term_memory: list = []
+        self.size = 0  # 歷史紀錄的估計位元組數，供 ConversationStore 的記憶體上限使用
+        self.tokens = 0  # 歷史紀錄的估計 token 數（以使用者訊息的格式計算，是提示中歷史的上限），供 ContextPacker 使用
+
+    @staticmethod
+    def _record_size(record: HistoryRecord) -> int:
+        return RECORD_OVERHEAD + sys.getsizeof(record.content or '')
+
+    @staticmethod
+    def _record_tokens(record: HistoryRecord) -> int:
+        return estimate_tokens(repr(record))
+
+    def _account(self, record: HistoryRecord, sign: int) -> None:
+        self.size += sign * self._record_size(record)
+        self.tokens += sign * self._record_tokens(record)
+
+    def _append(self, record: HistoryRecord) -> None:
+        if len(self.history) == self.history.maxlen:
+            self._msg_ids.discard(self.history[0].msg_id)
+            self._account(self.history[0], -1)
+        self.history.append(record)
+        self._msg_ids.add(record.msg_id)
+        self._account(record, 1)
+
+    def has_message(self, msg_id: int) -> bool:
+        return msg_id in self._msg_ids
+
+    def add_history(self, msg_id: int, author_id: int, author_name: str, content: str,
+                    created_at: Union[datetime, float, str, None] = None) -> None:
+        # 若已存在該 msg_id 則不重複加入
+        if msg_id in self._msg_ids:
+            return
+        self._append(HistoryRecord(msg_id, author_id, author_name, content, created_at))
+
+    def update_history(self, msg_id: int, content: str) -> bool:
+        """訊息被編輯（例如串流回覆逐步編輯）後更新歷史中的內容"""
+        if msg_id not in self._msg_ids:
+            return False
+        for record in reversed(self.history):
+            if record.msg_id == msg_id:
+                self._account(record, -1)
+                record.content = content
+                self._account(record, 1)
+                return True
+        return False
+
+    async def add_history_from_db(self, db: AsyncDatabaseManager, channel: discord.abc.Messageable) -> None:
+        """從本地訊息紀錄補上歷史
+
+        每個頻道在這次執行中第一次載入時，先向 Discord 補抓訊息紀錄中最後一則之後的新訊息
+        （只抓最新的 maxlen 則，通常是重新啟動期間的訊息）；之後的載入（例如快照重新載入）只讀本地紀錄。
+        再以索引讀取本地紀錄中比目前歷史更新的訊息。
+        """
+        if not isinstance(channel, discord.abc.Messageable):
+            print("提供的頻道不是 TextChannel 類型")
+            return
+        if channel.id not in caught_up_channels:
+            last_id = await db.get_last_message_id(channel.id)
+            fetched = []
+            after = discord.Object(id=last_id) if last_id else None
+            async for msg in channel.history(limit=self.history.maxlen, after=after, oldest_first=False):
+                msg: discord.Message = msg
+                fetched.append((msg.id, channel.id, msg.author.id, msg.author.name, msg.content, msg.created_at.timestamp()))
+            await db.append_messages(fetched)
+            caught_up_channels.add(channel.id)
+        newest = self.history[-1].msg_id if self.history else None
+        for record in await db.get_messages(channel.id, limit=self.history.maxlen, after_id=newest):
+            self.add_history(*record)
+
+    def to_json(self) -> str:
+        """序列化成快照（歷史紀錄與記憶 id 的剩餘次數）"""
+        return json.dumps({
+            'max_count': self.history.maxlen,
+            'history': [[m.msg_id, m.author_id, m.name, m.content, m.created_at] for m in self.history],
+            'users_id': self.users_id,
+            'channels_id': self.channels_id,
+            'servers_id': self.servers_id,
+        }, ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, data: str) -> 'conversation':
+        snapshot = json.loads(data)
+        conv = cls(snapshot.get('max_count') or history_maxcount)
+        for record in snapshot['history']:
+            conv.add_history(*record)
+        conv.users_id = {int(k): v for k, v in snapshot['users_id'].items()}
+        conv.channels_id = {int(k): v for k, v in snapshot['channels_id'].items()}
+        conv.servers_id = {int(k): v for k, v in snapshot['servers_id'].items()}
+        return conv
+
+    def get_history(self):
+        return "\n".join(f"{m.timestamp} id={m.author_id} name={m.name}: {m.content}" for m in self.history)
+
+    def add_memusers_id(self, user_id: int, count: int = 5) -> None:
+        """設定對話記憶使用者id"""
+        self.users_id[user_id] = count
+    def add_memchannels_id(self, channel_id: int, count: int = 5) -> None:
+        """設定對話記憶頻道id"""
+        self.channels_id[channel_id] = count
+    def add_memservers_id(self, server_id: int, count: int = 5) -> None:
+        """設定對話記憶伺服器id"""
+        self.servers_id[server_id] = count
+
+    def get_memusers_id(self) -> dict[int, int]:
+        """取得對話記憶使用者id清單"""
+        return list(self.users_id.keys())
+    def get_memchannels_id(self) -> dict[int, int]:
+        """取得對話記憶頻道id清單"""
+        return list(self.channels_id.keys())
+    def get_memservers_id(self) -> dict[int, int]:
+        """取得對話記憶伺服器id清單"""
+        return list(self.servers_id.keys())
+
+    def id_list_update(self):
+        # 更新 users_id, channels_id, servers_id 的剩餘次數
+        for user_id in list(self.users_id.keys()):
+            self.users_id[user_id] -= 1
+            if self.users_id[user_id] <= 0:
+                del self.users_id[user_id]
+        for channel_id in list(self.channels_id.keys()):
+            self.channels_id[channel_id] -= 1
+            if self.channels_id[channel_id] <= 0:
+                del self.channels_id[channel_id]
+        for server_id in list(self.servers_id.keys()):
+            self.servers_id[server_id] -= 1
+            if self.servers_id[server_id] <= 0:
+                del self.servers_id[server_id]
+        return
+
+
+class ConversationStore:
+    """全域對話表：依最近使用順序與閒置時間淘汰
+
+    記憶體中最多保留 max_conversations 個對話、歷史紀錄合計約 max_bytes 位元組（依內容長度估算），
+    超過時淘汰最久未使用的對話；閒置超過 idle_seconds 的也會被淘汰。
+    被淘汰的對話快照到 SQLite，下次收到訊息時再載入，重新啟動後也不需要重新向 Discord 拉取歷史。
+    同一個 key 同時只會有一個載入（open），其他同時到達的訊息等待同一個結果。
+    """
+    def __init__(self, db: AsyncDatabaseManager, max_conversations: int = 1000, idle_seconds: float = 3600.0,
+                 max_bytes: int = 64 * 1024 * 1024) -> None:
+        self.db = db
+        self.max_conversations = max_conversations
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        self._items: OrderedDict[str, conversation] = OrderedDict()
+        self._last_used: dict[str, float] = {}
+        self._opening: dict[str, asyncio.Future] = {}
+        self.loaded = 0
+        self.evicted = 0
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._items
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, key: str) -> Optional[conversation]:
+        """只查記憶體中的對話"""
+        conv = self._items.get(key)
+        if conv is not None:
+            self._touch(key)
+        return conv
+
+    async def load(self, key: str) -> Optional[conversation]:
+        """取得對話：記憶體中沒有時從快照載入，都沒有則回傳 None"""
+        conv = self.get(key)
+        if conv is not None:
+            return conv
+        data = await self.db.load_conversation_snapshot(key)
+        if data is None or key in self._items:
+            return self.get(key)
+        conv = conversation.from_json(data)
+        self.loaded += 1
+        await self.put(key, conv)
+        return conv
+
+    async def open(self, key: str, hydrate: Callable[[conversation], Awaitable[None]]) -> conversation:
+        """取得對話，不在記憶體中時載入快照或建立新對話，以 hydrate 補上歷史後才放入對話表
+
+        同一個 key 同時到達的呼叫共用同一次載入，不會建立兩個對話物件互相覆蓋。
+        """
+        conv = self.get(key)
+        if conv is not None:
+            return conv
+        opening = self._opening.get(key)
+        if opening is not None:
+            return await asyncio.shield(opening)
+        opening = self._opening[key] = asyncio.get_running_loop().create_future()
+        try:
+            data = await self.db.load_conversation_snapshot(key)
+            if data is not None:
+                conv = conversation.from_json(data)
+                self.loaded += 1
+            else:
+                conv = conversation()
+            await hydrate(conv)
+            await self.put(key, conv)
+            opening.set_result(conv)
+            return conv
+        except BaseException as e:
+            opening.set_exception(e)
+            opening.exception()  # 沒有其他等待者時不產生未取得例外的警告
+            raise
+        finally:
+            del self._opening[key]
+
+    async def put(self, key: str, conv: conversation) -> None:
+        self._items[key] = conv
+        self._touch(key)
+        await self.enforce_limits()
+
+    async def enforce_limits(self) -> int:
+        """超過數量或記憶體上限時淘汰最久未使用的對話（至少保留最近使用的一個），回傳淘汰數量"""
+        overflow = []
+        total = sum(conv.size for conv in self._items.values())
+        count = len(self._items)
+        for key, conv in self._items.items():
+            if count <= 1 or (count <= self.max_conversations and total <= self.max_bytes):
+                break
+            overflow.append(key)
+            count -= 1
+            total -= conv.size
+        if overflow:
+            await self._evict(overflow)
+        return len(overflow)
+
+    def _touch(self, key: str) -> None:
+        self._items.move_to_end(key)
+        self._last_used[key] = time.monotonic()
+
+    async def evict_idle(self) -> int:
+        """淘汰閒置過久的對話，回傳淘汰數量"""
+        deadline = time.monotonic() - self.idle_seconds
+        idle = [key for key in self._items if self._last_used.get(key, 0) < deadline]
+        await self._evict(idle)
+        return len(idle) + await self.enforce_limits()  # 對話的歷史會持續增加，定時重新檢查記憶體上限
+
+    async def _evict(self, keys: list) -> None:
+        snapshots = []
+        for key in keys:
+            conv = self._items.pop(key, None)
+            self._last_used.pop(key, None)
+            if conv is not None:
+                snapshots.append((key, conv.to_json()))
+        self.evicted += len(snapshots)
+        await self.db.save_conversation_snapshots(snapshots)
+
+    def snapshot_all(self) -> None:
+        """關閉前同步保存所有對話（事件迴圈已結束時使用）"""
+        self.db.db.save_conversation_snapshots([(key, conv.to_json()) for key, conv in self._items.items()])
+
+    def stats(self) -> dict:
+        return {
+            'in_memory': len(self._items),
+            'max_conversations': self.max_conversations,
+            'estimated_bytes': sum(conv.size for conv in self._items.values()),
+            'max_bytes': self.max_bytes,
+            'loaded': self.loaded,
+            'evicted': self.evicted,
+        }
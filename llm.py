@@ -0,0 +1,58 @@
+import asyncio
+from typing import AsyncIterator, Optional
+
+from google import genai
+from google.genai import types
+
+
+class GeminiClientManager:
+    """整個 bot 共用一個長期存在的 Gemini client
+
+    使用 client.aio 的非同步 API，底層 HTTP 連線會被重複使用；
+    同時進行的請求數以 semaphore 限制，不同頻道的回覆可以並行產生而不會卡住事件迴圈。
+    """
+    def __init__(self, api_key: str, model: str = "gemini-2.5-flash", max_concurrency: int = 4,
+                 timeout_ms: Optional[int] = None) -> None:
+        http_options = types.HttpOptions(timeout=timeout_ms) if timeout_ms else None
+        self.client = genai.Client(api_key=api_key, http_options=http_options)
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.in_flight = 0
+        self.waiting = 0
+
+    async def generate(self, contents: list, config: Optional[types.GenerateContentConfig] = None,
+                       model: Optional[str] = None) -> types.GenerateContentResponse:
+        self.waiting += 1
+        async with self._semaphore:
+            self.waiting -= 1
+            self.in_flight += 1
+            try:
+                return await self.client.aio.models.generate_content(
+                    model=model or self.model,
+                    contents=contents,
+                    config=config,
+                )
+            finally:
+                self.in_flight -= 1
+
+    async def generate_stream(self, contents: list, config: Optional[types.GenerateContentConfig] = None,
+                              model: Optional[str] = None) -> AsyncIterator[types.GenerateContentResponse]:
+        """串流版本的 generate，逐段產生回應；整個串流期間都佔用一個並行名額"""
+        self.waiting += 1
+        async with self._semaphore:
+            self.waiting -= 1
+            self.in_flight += 1
+            try:
+                stream = await self.client.aio.models.generate_content_stream(
+                    model=model or self.model,
+                    contents=contents,
+                    config=config,
+                )
+                async for chunk in stream:
+                    yield chunk
+            finally:
+                self.in_flight -= 1
+
+    def stats(self) -> dict:
+        return {'in_flight': self.in_flight, 'waiting': self.waiting, 'max_concurrency': self.max_concurrency}
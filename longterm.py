@@ -0,0 +1,63 @@
+import time
+from typing import Optional
+
+import discord
+
+from memorydb import AsyncDatabaseManager
+from conversation import TIMEZONE_OFFSET
+
+LONG_TERM_MEMORY_FOOTER = '[以上為先前整理的記憶,已登入準備聊天]'
+
+
+class LongTermMemory:
+    """長期記憶頻道（Memory_Channel）的本地鏡像
+
+    頻道中的摘要依 msg_id 增量同步到 long_term_memories，啟動時只向 Discord 抓最後一則之後的新訊息；
+    放進提示的文字區塊只在同步到新摘要後重新產生，其餘時間直接使用快取。
+    """
+    def __init__(self, db: AsyncDatabaseManager, channel_id: Optional[int], max_entries: int = 100) -> None:
+        self.db = db
+        self.channel_id = channel_id
+        self.max_entries = max_entries
+        self._block: Optional[str] = None
+        self.synced = 0
+
+    async def sync(self, channel: discord.abc.Messageable) -> int:
+        """把頻道中尚未鏡像的摘要寫入資料庫，回傳新增數量；第一次同步只抓最新的 max_entries 則"""
+        last_id = await self.db.get_last_long_term_memory_id(channel.id)
+        if last_id:
+            history = channel.history(limit=None, after=discord.Object(id=last_id))
+        else:
+            history = channel.history(limit=self.max_entries)
+        rows = [(msg.id, channel.id, msg.content, msg.created_at.timestamp()) async for msg in history if msg.content]
+        if rows:
+            await self.db.save_long_term_memories(rows)
+            self.synced += len(rows)
+            self.invalidate()
+        return len(rows)
+
+    def invalidate(self) -> None:
+        self._block = None
+
+    async def block(self) -> str:
+        """提示用的長期記憶區塊（快取）"""
+        if self.channel_id is None:
+            return ''
+        if self._block is None:
+            rows = await self.db.get_long_term_memories(self.channel_id, self.max_entries)
+            self._block = self.render(rows)
+        return self._block
+
+    @staticmethod
+    def render(rows: list) -> str:
+        """摘要依日期分組，每個日期只列一次：[2025/01/02] 後接當天的摘要"""
+        lines = []
+        day = None
+        for _, content, created_at in rows:
+            date = time.strftime('%Y/%m/%d', time.gmtime(created_at + TIMEZONE_OFFSET))
+            if date != day:
+                lines.append(f'[{date}]')
+                day = date
+            lines.append(content.strip())
+        lines.append(LONG_TERM_MEMORY_FOOTER)
+        return '\n'.join(lines)
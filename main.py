@@ -2,14 +2,27 @@ import discord
 from discord import app_commands
 from discord.ext import commands, tasks
 from discord.ui import Button, View, Select
-from google import genai
 from google.genai import types
 import asyncio
 import random
 import json, time
 from datetime import datetime, timedelta
 from typing import Optional
-from memorydb import DatabaseManager
+from memorydb import AsyncDatabaseManager
+from llm import GeminiClientManager
+from conversation import conversation, ConversationStore
+from longterm import LongTermMemory
+from streaming import StreamingMessage
+from tools import ToolRegistry
+from prompting import ContextPacker, PromptRenderer
+from summarizer import RollingSummarizer, SummaryPipeline
+from moderation import Blocklist
+from ratelimit import RateLimiter, RATE_SCOPES
+from scheduler import ChannelDebouncer, ReplyScheduler, PRIORITY_DM, PRIORITY_MENTION, PRIORITY_AUTOCHAT
+try:
+    from vectorindex import VectorIndex, HashingEmbedder, GeminiEmbedder
+except ImportError:  # 向量記憶需要 numpy，沒有安裝時停用
+    VectorIndex = None
 
 print("import完成")
 print("開始讀取設定")
@@ -33,24 +46,67 @@ except json.decoder.JSONDecodeError:
 print("載入聊天頻道清單")
 try:
     with open("AutoChatChannels.json", "r") as f:
-        AUTOCHAT_CHANNELS = [int(cid) for cid in json.load(f)]
+        AUTOCHAT_CHANNELS = {int(cid) for cid in json.load(f)}  # set：每則訊息都要 O(1) 查詢
 except FileNotFoundError:
-    AUTOCHAT_CHANNELS = []
+    AUTOCHAT_CHANNELS = set()
     with open("AutoChatChannels.json", "w") as f:
-        json.dump(AUTOCHAT_CHANNELS, f)
-
-db = DatabaseManager()
+        json.dump([], f)
+
+db = AsyncDatabaseManager()  # 資料庫操作皆在背景執行緒進行，不阻塞事件迴圈
+
+# 共用的 Gemini client，限制同時進行的請求數
+gemini = GeminiClientManager(
+    api_key=CONFIG['Gemini_Token'],
+    model=CONFIG['model'] if 'model' in CONFIG else "gemini-2.5-flash",
+    max_concurrency=int(CONFIG.get('gemini_max_concurrency', 4)),
+    timeout_ms=CONFIG.get('gemini_timeout_ms'),
+)
+
+# 語意記憶索引：預設使用離線的雜湊 embedder，Config.json 設定 "embedder": "gemini" 時改用 Gemini
+vector_index = None
+if VectorIndex is not None and CONFIG.get('vector_memory', True):
+    if CONFIG.get('embedder') == 'gemini':
+        embedder = GeminiEmbedder(gemini.client)
+    else:
+        embedder = HashingEmbedder()
+    vector_index = VectorIndex(db.db, embedder)
+
+# 封鎖名單：被忽略或多次警告的使用者在任何資料庫或 LLM 工作之前就被擋下，寫入使用者狀態時同步更新
+blocklist = Blocklist(
+    throttle_warnings=int(CONFIG.get('throttle_warnings', 3)),
+    ignore_warnings=int(CONFIG.get('ignore_warnings', 5)),
+    throttle_interval=float(CONFIG.get('throttle_interval_seconds', 60)),
+)
+blocklist.load(db.db.get_moderated_users())
+db.db.add_user_state_listener(blocklist.on_user_state)
+
+# 限流：使用者、頻道、伺服器與全域的令牌桶，以及每日 token 用量上限（用量記錄在 SQLite）
+rate_limiter = RateLimiter(
+    CONFIG.get('rate_limits', {
+        'user': {'capacity': 5, 'per_minute': 6},
+        'channel': {'capacity': 10, 'per_minute': 20},
+        'server': {'capacity': 20, 'per_minute': 40},
+    }),
+    CONFIG.get('daily_token_limits', {}),
+    notify_interval=float(CONFIG.get('rate_limit_notify_seconds', 60)),
+)
+rate_limiter.load(db.db.get_llm_usage(rate_limiter.day))
+
+# 寫入 Config.json（限流設定在執行中調整後保存）
+def save_CONFIG():
+    with open("Config.json", "w") as f:
+        json.dump(CONFIG, f, indent=4, ensure_ascii=False)
 
 # 寫入 AutoChatChannels
 def save_AUTOCHAT_CHANNELS(channels):
     with open("AutoChatChannels.json", "w") as f:
-        json.dump(channels, f, indent=4)
+        json.dump(sorted(channels), f, indent=4)
 
 # 判斷是否為管理員或 Bot 擁有者
 def is_admin_or_owner(interaction: discord.Interaction):
     if interaction.user.id == int(CONFIG['Your_Discord_Id']):
         return True
-    if interaction.user.guild_permissions.administrator:
+    if isinstance(interaction.user, discord.Member) and interaction.user.guild_permissions.administrator:  # 私訊中沒有伺服器權限
         return True
     return False
 
@@ -68,144 +124,82 @@ intents.guilds = True
 intents.message_content = True
 bot = commands.Bot(command_prefix='cate:', intents=intents)
 
-global_contents: list = []  # 用於存儲訊息內容
-
-async def get_long_term_memory() -> str:   
-    channel = bot.get_channel(int(CONFIG['Memory_Channel']))
+# 長期記憶：Memory_Channel 的摘要鏡像到本地資料表，提示用的區塊快取到有新摘要為止
+long_term = LongTermMemory(
+    db,
+    int(CONFIG['Memory_Channel']) if CONFIG.get('Memory_Channel') else None,
+    max_entries=int(CONFIG.get('long_term_memory_entries', 100)),
+)
+
+# 同步長期記憶頻道中的新摘要
+async def sync_long_term_memory() -> None:
+    if long_term.channel_id is None:
+        print("長期記憶頻道未設定，請在Config.json中設定Memory_Channel")
+        return
+    channel = bot.get_channel(long_term.channel_id)
     if channel:
-        messages = []
-        async for msg in channel.history(limit=100):
-            messages.append(msg.content)
-        print("長期記憶：")
-        for m in reversed(messages):  # 由舊到新
-            print(m)
+        added = await long_term.sync(channel)
+        print(f"長期記憶已同步，新增 {added} 則")
     else:
         print("找不到指定頻道")
-    msg = str(messages)+'[以上為先前整理的記憶,已登入準備聊天]'
-    return msg
+
+# 滾動摘要：把先前的摘要與一批新的對話片段整合成新的摘要
+summary_max_chars = int(CONFIG.get('summary_max_chars', 1500))
+
+async def summarize_segments(previous: str, segments: list) -> str:
+    prompt = f"先前的摘要:\n{previous or '（無）'}\n\n新的對話紀錄:\n" + "\n".join(segments) \
+        + f"\n\n請把新的對話併入先前的摘要，整理成 {summary_max_chars} 字以內的摘要，保留重要的人物、事件與約定。"
+    response = await gemini.generate(contents=[types.Content(role="user", parts=[types.Part.from_text(text=prompt)])])
+    rate_limiter.record(None, None, None, response.usage_metadata)  # 摘要只計入全域用量
+    return response.text
+
+# 各頻道的對話片段存在 SQLite，每累積一定數量就在背景併入該頻道的摘要
+summarizer = RollingSummarizer(
+    db, summarize_segments,
+    max_segments=int(CONFIG.get('summary_every_messages', 40)),
+    max_chars=int(CONFIG.get('summary_every_chars', 6000)),
+    max_summary_chars=summary_max_chars,
+    max_parallel=int(CONFIG.get('summary_max_parallel', 4)),
+)
+
+# 把多份摘要整合成一份（伺服器摘要、全域摘要）
+async def reduce_summaries(label: str, summaries: list) -> str:
+    prompt = f"以下是{label}中各部分的摘要:\n\n" + "\n\n".join(summaries) \
+        + f"\n\n請整合成 {summary_max_chars} 字以內的摘要，保留重要的人物、事件與約定。"
+    response = await gemini.generate(contents=[types.Content(role="user", parts=[types.Part.from_text(text=prompt)])])
+    rate_limiter.record(None, None, None, response.usage_metadata)
+    return response.text
+
+# 每晚的階層式摘要：頻道 -> 伺服器 -> 全域，分別寫入頻道、伺服器與核心記憶
+summary_pipeline = SummaryPipeline(
+    db, summarizer, reduce_summaries,
+    max_parallel=int(CONFIG.get('summary_max_parallel', 4)),
+    fan_in=int(CONFIG.get('summary_fan_in', 8)),
+)
 
 # 整理並且新增長期記憶
 async def update_long_term_memory() -> None:
     channel = bot.get_channel(int(CONFIG['Memory_Channel']))
     if channel:
-        global_contents.append(
-            types.Content(
-                role="user",
-                parts=[
-                    types.Part.from_text(text=f"整理以上對話的摘要"),
-                ],
-            )
-        )
-        print(f"\n記憶:\n{global_contents}\n")
-        client = genai.Client(api_key=CONFIG['Gemini_Token'])
-        response = client.models.generate_content(
-            model= CONFIG['model'] if 'model' in CONFIG else "gemini-2.5-flash",
-            contents=global_contents
-        )
-        await send_in_chunks(channel, response.text)
-        print(f"\n已新增長期記憶:\n{response.text}\n")
-        global_contents.clear()  # 清空全域內容
+        summary = await summary_pipeline.run()
+        print(f"摘要流程: {summary_pipeline.last_run}")
+        if not summary:
+            print("沒有需要整理的對話")
+            return
+        await send_in_chunks(channel, summary)
+        print(f"\n已新增長期記憶:\n{summary}\n")
+        await sync_long_term_memory()  # 鏡像剛送出的摘要，提示區塊隨之重建
     else:
         print("找不到指定頻道")
 
 
-conversations = {}
-history_maxcount: int = 30
-class conversation:
-    def __init__(self):
-        self.history: list = []  # [{'msg_id': int, 'author_id': int, 'content': str}]
-        self.users_id: dict[int, int] = {}  # id:剩餘次數
-        self.channels_id: dict[int, int] = {}
-        self.servers_id: dict[int, int] = {}
-        self.long_term_memory: list = []
-
-    def add_history(self, msg_id: int, author_id: int, author_name: str, content: str, timestamp: Optional[str] = None, max_count: int = history_maxcount):
-        # 若已存在該 msg_id 則不重複加入
-        if any(m['msg_id'] == msg_id for m in self.history):
-            return
-        self.history.append({'msg_id': msg_id, 'author_id': author_id,'name': author_name, 'content': content, 'timestamp': timestamp or str(time.strftime("%Y/%m/%d %a. %H:%M", time.localtime()))})
-        if len(self.history) > int(max_count):
-            self.history.pop(0)
-
-    async def add_history_from_dc(self, channel:discord.abc.Messageable, max_count=history_maxcount):
-        """從 Discord 頻道拉取歷史訊息，遇到已存在的 msg_id 就停止"""
-        temp_history = []
-        if not isinstance(channel, discord.abc.Messageable):
-            print("提供的頻道不是 TextChannel 類型")
-            return
-        async for msg in channel.history(limit=max_count):
-            msg: discord.Message = msg
-            if any(m['msg_id'] == msg.id for m in self.history):
-                break
-            temp_history.append({
-                'msg_id': msg.id,
-                'author_id': msg.author.id,
-                'name': msg.author.name,
-                'content': msg.content,
-                'timestamp': (msg.created_at + timedelta(hours=8)).strftime("%Y/%m/%d %a. %H:%M") # 轉換為台灣時間
-            })
-        temp_history.reverse()
-        self.history.extend(temp_history)
-        if len(self.history) > int(max_count):
-            self.history = self.history[-max_count:]
-
-    def get_history(self):
-        return "\n".join([f"{m['timestamp']} id={m['author_id']} name={m['name']}: {m['content']}" for m in self.history])
-
-    def add_memusers_id(self, user_id: int, count: int = 5) -> None:
-        """設定對話記憶使用者id"""
-        self.users_id[user_id] = count
-    def add_memchannels_id(self, channel_id: int, count: int = 5) -> None:
-        """設定對話記憶頻道id"""
-        self.channels_id[channel_id] = count
-    def add_memservers_id(self, server_id: int, count: int = 5) -> None:
-        """設定對話記憶伺服器id"""
-        self.servers_id[server_id] = count
-
-    def get_memusers_id(self) -> dict[int, int]:
-        """取得對話記憶使用者id清單"""
-        return list(self.users_id.keys())
-    def get_memchannels_id(self) -> dict[int, int]:
-        """取得對話記憶頻道id清單"""
-        return list(self.channels_id.keys())
-    def get_memservers_id(self) -> dict[int, int]:
-        """取得對話記憶伺服器id清單"""
-        return list(self.servers_id.keys())
-
-    def id_list_update(self):
-        # 更新 users_id, channels_id, servers_id 的剩餘次數
-        for user_id in list(self.users_id.keys()):
-            self.users_id[user_id] -= 1
-            if self.users_id[user_id] <= 0:
-                del self.users_id[user_id]
-        for channel_id in list(self.channels_id.keys()):
-            self.channels_id[channel_id] -= 1
-            if self.channels_id[channel_id] <= 0:
-                del self.channels_id[channel_id]
-        for server_id in list(self.servers_id.keys()):
-            self.servers_id[server_id] -= 1
-            if self.servers_id[server_id] <= 0:
-                del self.servers_id[server_id]
-        return
-
-
-# 獲取長期記憶
-async def get_long_term_memory() -> str:
-    if not CONFIG['Memory_Channel']:
-        print("長期記憶頻道未設定")
-        return "長期記憶頻道未設定，請在Config.json中設定Memory_Channel"
-    channel = bot.get_channel(int(CONFIG['Memory_Channel']))
-    if channel:
-        messages = []
-        async for msg in channel.history(limit=100):
-            messages.append(msg.content)
-        print("長期記憶：")
-        for m in reversed(messages):  # 由舊到新
-            print(m)
-    else:
-        print("找不到指定頻道")
-    msg = str(messages)+'[以上為先前整理的記憶,已登入準備聊天]'
-    return msg
+# 對話表：閒置或超過上限的對話快照到 SQLite，需要時再載入
+conversations = ConversationStore(
+    db,
+    max_conversations=int(CONFIG.get('conversation_cache_size', 1000)),  # 對話數量上限
+    idle_seconds=float(CONFIG.get('conversation_idle_seconds', 3600)),
+    max_bytes=int(CONFIG.get('conversation_cache_mb', 64)) * 1024 * 1024,  # 依歷史內容估算的記憶體上限
+)
 
 #define function
 add_important_memory_declatation = {
@@ -228,7 +222,7 @@ add_important_memory_declatation = {
     }
 }
 
-def add_important_memory(message:discord.Message ,scope: str, content: str) -> str:
+async def add_important_memory(message:discord.Message ,scope: str, content: str) -> str:
     """將需要長期保存的資訊或對話存入記憶，例如重要事件、關鍵訊息或用戶需求，並根據範圍（使用者、頻道或伺服器）選擇適當的存儲方式。
     
     Args:
@@ -242,182 +236,383 @@ def add_important_memory(message:discord.Message ,scope: str, content: str) -> s
         return "無效的範圍選擇，請選擇 'user', 'channel' 或 'server'。"
     if not content:
         return "內容不能為空，請提供要儲存的內容。"
+    if scope == "server" and message.guild is None:
+        return "私訊中沒有伺服器，請改用 'user' 或 'channel'。"
     try:
         if scope == "user":
-            db.add_user_memory(message.author.id, content)
+            result = await db.add_user_memory(message.author.id, content)
         elif scope == "channel":
-            db.add_channel_memory(message.channel.id, content)
-        elif scope == "server" and message.guild:
-            db.add_server_memory(message.guild.id, content)
+            result = await db.add_channel_memory(message.channel.id, content)
+        else:
+            result = await db.add_server_memory(message.guild.id, content)
+        if not result.startswith("已新增"):  # 資料庫錯誤以字串回傳
+            print(f"儲存記憶失敗：{result}")
+            return f"喵了個咪儲存記憶出錯啦: {result}"
         print(f"已儲存重要記憶：{scope} - {content}")
         return f"{content} 記住了喵！"
     except Exception as e:
         print(f"儲存記憶時發生錯誤: {e}")
         return f"喵了個咪儲存記憶出錯啦: {e}"
 
+search_memory_declaration = {
+    "name": "search_memory",
+    "description": "在已儲存的記憶中搜尋與關鍵字相關的內容，用於回想使用者、頻道、伺服器或核心記憶中較早的資訊。",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "query": {
+                "type": "string",
+                "description": "要搜尋的關鍵字或句子"
+            },
+            "scope": {
+                "type": "string",
+                "enum": ["user", "channel", "server", "core"],
+                "description": "搜尋範圍：目前的使用者、頻道、伺服器或核心記憶"
+            }
+        },
+        "required": ["query", "scope"]
+    }
+}
+
+# 模型可呼叫的函數；同一回合的所有呼叫並行執行，結果一次送回
+tool_registry = ToolRegistry()
+tool_registry.register(add_important_memory_declatation, visible=True)(add_important_memory)
+
+@tool_registry.register(search_memory_declaration)
+async def search_memory(message: discord.Message, query: str, scope: str) -> dict:
+    owners = {
+        'user': [message.author.id],
+        'channel': [message.channel.id],
+        'server': [message.guild.id] if message.guild else [0],
+        'core': None,
+    }
+    if scope not in owners:
+        return {'error': "無效的範圍選擇，請選擇 'user', 'channel', 'server' 或 'core'。"}
+    found = await db.search_memories(query, scope, owners[scope], k=int(CONFIG.get('search_memory_limit', 5)))
+    return {'memories': [{'content': m['content'], 'timestamp': m['timestamp']} for m in found]}
+
+def response_parts(response: types.GenerateContentResponse) -> list:
+    if not response.candidates or not response.candidates[0].content:
+        return []
+    return response.candidates[0].content.parts or []
+
+# 產生回覆並處理函數呼叫：每回合的所有函數呼叫並行執行，結果以 function_response 在下一回合一次送回；
+# 最後一回合不提供工具以確保得到文字。stream 不為 None 時邊產生邊顯示。回傳要顯示的完整回覆
+async def generate_with_tools(message: discord.Message, contents: list, config: types.GenerateContentConfig,
+                              text_config: types.GenerateContentConfig, commit=None,
+                              stream: Optional[StreamingMessage] = None) -> str:
+    reply_text = ''
+    max_rounds = int(CONFIG.get('max_tool_rounds', 3))
+    owner_ids = (message.author.id, message.channel.id, message.guild.id if message.guild else None)
+    for round_index in range(max_rounds + 1):
+        round_config = config if round_index < max_rounds else text_config
+        texts, calls = [], []
+        if stream is not None:
+            usage = None
+            async for chunk in gemini.generate_stream(contents=contents, config=round_config):
+                usage = chunk.usage_metadata or usage  # 最後一段帶有整個回應的用量
+                if commit:
+                    commit()  # 開始收到回應後（執行工具、送出回覆前）就不再被新訊息取消
+                for part in response_parts(chunk):
+                    if part.function_call:
+                        calls.append(part)
+                    elif part.text and not part.thought:
+                        texts.append(part.text)
+                        await stream.feed(part.text)
+            rate_limiter.record(*owner_ids, usage)
+        else:
+            response = await gemini.generate(contents=contents, config=round_config)
+            rate_limiter.record(*owner_ids, response.usage_metadata)
+            if commit:
+                commit()  # 生成完成後（執行工具、送出回覆前）就不再被新訊息取消
+            for part in response_parts(response):
+                if part.function_call:
+                    calls.append(part)
+                elif part.text and not part.thought:
+                    texts.append(part.text)
+        reply_text += ''.join(texts)
+        if not calls:
+            break
+        # 模型這回合的內容（保留原本的 function_call part）與所有函數結果
+        contents.append(types.Content(
+            role="model",
+            parts=([types.Part.from_text(text=''.join(texts))] if texts else []) + calls,
+        ))
+        results, visible_texts = await tool_registry.dispatch(message, [part.function_call for part in calls])
+        contents.append(types.Content(role="user", parts=results))
+        if visible_texts:
+            visible = '\n'.join(visible_texts) + '\n'
+            reply_text += visible
+            if stream is not None:
+                await stream.feed(visible)
+    return reply_text
+
+async def generate_reply(conv: conversation, messages: list, commit=None) -> None:
+    """針對一則或多則（合併後的）訊息產生一次回覆，message 為最後一則"""
+    message: discord.Message = messages[-1]
+    query = "\n".join(m.content for m in messages)
+    async with message.channel.typing():
+        # 取得記憶
+        memory_limits = CONFIG.get('memory_limits', {})
+        context = await db.get_conversation_context(
+            conv.get_memusers_id(), conv.get_memchannels_id(), conv.get_memservers_id(),
+            user_limit=memory_limits.get('user', 5),
+            channel_limit=memory_limits.get('channel', 10),
+            server_limit=memory_limits.get('server', 10),
+            query=query,
+            relevant_limit=memory_limits.get('relevant', 3),
+        )
+        print(f"取得記憶耗時 {context['elapsed_ms']:.1f} ms")
+        # 語意相近的記憶（略過已經放進提示的記憶）
+        semanticmem = {}
+        if vector_index:
+            partitions = [('user', user['user_id']) for user in context['users']] \
+                + [('channel', channel['channel_id']) for channel in context['channels']] \
+                + [('server', server['server_id']) for server in context['servers']] + [('core', 0)]
+            seen = {(scope, m['id']) for scope, entities in (('user', context['users']), ('channel', context['channels']), ('server', context['servers']))
+                    for entity in entities for m in entity['memories']}
+            seen |= {(scope, m['id']) for scope, found in context['relevant'].items() for m in found}
+            try:
+                semanticmem = await asyncio.to_thread(vector_index.search, query, partitions, memory_limits.get('semantic', 3), seen)
+            except Exception as e:
+                print(f"語意記憶搜尋失敗，略過: {e}")  # 不影響回覆
+
+        # 依 token 預算挑選提示內容：最近的對話 > 與訊息相關的記憶 > 各實體的近期記憶 > 長期記憶
+        turns = []
+        for msg in conv.history:
+            if msg.author_id == bot.user.id:
+                turns.append((msg.msg_id, "model", f"{msg.content}"))
+            else:
+                turns.append((msg.msg_id, "user", f"{msg.timestamp} id={msg.author_id} name={msg.name}: {msg.content}"))
+        ranked = [((kind, scope, m['id']), m) for kind, found_by_scope in (('relevant', context['relevant']), ('semantic', semanticmem))
+                  for scope, found in found_by_scope.items() for m in found]
+        entities = [((scope, entity[f'{scope}_id']), entity) for scope, found in (('user', context['users']), ('channel', context['channels']), ('server', context['servers']))
+                    for entity in found]
+        long_term_block = await long_term.block()
+        packed = prompt_packer.pack([
+            ('history', [(msg_id, text) for msg_id, _, text in reversed(turns)], True, conv.tokens),
+            ('memory', [(key, prompt_renderer.render_memory(key[1], m)) for key, m in ranked], False),
+            ('entity', [(key, prompt_renderer.render_entity(key[0], entity)) for key, entity in entities], False),
+            ('long_term', [(0, long_term_block)], False),
+        ])
+        if packed.dropped:
+            print(packed.report())
+
+        memory = prompt_renderer.render_context(
+            [(key[0], entity) for key, entity in entities if packed.has('entity', key)],
+            [(f'{key[0]} memories', key[1], m) for key, m in ranked if packed.has('memory', key)],
+        )
+
+        contents = []
+        contents.append(
+            types.Content(
+                role="model",
+                parts=[
+                    types.Part.from_text(text=f"\n{long_term_block if packed.has('long_term', 0) else ''}\n\n{memory}"),
+                    # types.Part.from_text(text=f"\nmemory\n\n{memory}\n\n")
+                ],
+            )
+        )
+
+        for index, (msg_id, role, text) in enumerate(turns):
+            # 最新的一則即使超出預算也一定放入
+            if not packed.has('history', msg_id) and index != len(turns) - 1:
+                continue
+            contents.append(
+                types.Content(
+                role=role,
+                parts=[
+                    types.Part.from_text(text=text),
+                ],
+            ))
+        
+        # AI 回覆
+        generate_content_config = types.GenerateContentConfig(
+            tools=[types.Tool(function_declarations=tool_registry.declarations())],
+            system_instruction="你是個年齡不確定的貓娘,主要用正體中文,名字是CaTe像貓並參考元素表,身高130cm體重30kg,AquaNya是維護者,已使用帳號{bot.users}接入discord聊天,你將會收到許多資訊,回覆時不需包含這些格式,只需要針對用戶所說進行簡短對話。可以將重要的事情用Tool存下來。需要呼叫用戶時用 <@id> 。",
+            response_mime_type="text/plain",
+        )
+        generate_content_config_text = types.GenerateContentConfig(
+            system_instruction="你是個年齡不確定的貓娘,主要用正體中文,名字是CaTe像貓並參考元素表,身高130cm體重30kg,AquaNya是維護者,已使用帳號{bot.users}接入discord聊天,你將會收到許多資訊,回覆時不需包含這些格式,只需要針對用戶所說進行簡短對話。可以將重要的事情用Tool存下來。需要呼叫用戶時用 <@id> 。",
+        )
+
+        #AI 生成內容
+        print(contents)
+        reply_text = None
+        streamed = False
+        if CONFIG.get('stream_replies', True):
+            # 串流回覆：第一段文字一到就送出，之後分批編輯同一則訊息，超過長度上限時接到新訊息
+            stream = StreamingMessage(message.channel, max_dc_msg_length, float(CONFIG.get('stream_edit_interval', 1.0)))
+            base_length = len(contents)
+            try:
+                await generate_with_tools(message, contents, generate_content_config, generate_content_config_text, commit, stream)
+                reply_text = await stream.finish()
+                streamed = True
+            except Exception as e:
+                print(f"串流回覆時發生錯誤: {e}")
+                if stream.started or len(contents) > base_length:
+                    # 已經送出內容或執行過函數，不再重新產生
+                    await stream.feed(f"\n喵喵喵？腦袋打結啦 {e}")
+                    reply_text = await stream.finish()
+                    streamed = True
+        if reply_text is None:
+            reply_text = await generate_with_tools(message, contents, generate_content_config, generate_content_config_text, commit)
+
+        if reply_text:
+            if not streamed:
+                await send_in_chunks(message.channel, reply_text)
+            await summarizer.add(message.channel.id, message.guild.id if message.guild else 0,
+                                 f"{str(time.strftime('%Y/%m/%d %a. %H:%M', time.localtime()))} name={bot.user.name} : {reply_text}")
+        else:
+            await message.channel.send("喵喵喵？我不知道該怎麼回答喵！")
+
+
+# 提示內容的 token 預算與記憶的精簡格式（新增記憶時作廢該實體的快取）
+prompt_packer = ContextPacker(int(CONFIG.get('prompt_token_budget', 8000)))
+prompt_renderer = PromptRenderer(float(CONFIG.get('prompt_render_ttl', 60)))
+db.db.add_memory_listener(prompt_renderer.on_memory_added)
+
+# 回覆排程：同頻道依序執行，全域固定數量的 worker 依優先序處理
+reply_scheduler = ReplyScheduler(
+    workers=int(CONFIG.get('reply_workers', 4)),
+    max_queue_per_channel=int(CONFIG.get('reply_queue_per_channel', 4)),
+    max_pending=int(CONFIG.get('reply_queue_total', 256)),
+)
+
+async def reply_to_burst(conv_key: str, messages: list, commit) -> None:
+    conv = conversations.get(conv_key)
+    if conv is None:
+        return
+    await reply_scheduler.run(conv_key, PRIORITY_AUTOCHAT, lambda: generate_reply(conv, messages, commit), merge=True)
+
+# 自動聊天頻道：window 秒內的連續訊息合併成一次回覆
+autochat_debouncer = ChannelDebouncer(float(CONFIG.get('autochat_debounce_seconds', 2.0)), reply_to_burst)
+
+
+# 超過限流時的回覆（不經過 LLM）
+def rate_limit_text(scope: str, message: discord.Message) -> str:
+    retry = rate_limiter.retry_after(scope, message.author.id, message.channel.id, message.guild.id if message.guild else None)
+    if retry is None:
+        return "喵…今天聊太多了，明天再來找我吧！"
+    who = {'user': '你', 'channel': '這個頻道', 'server': '這個伺服器', 'global': '大家'}[scope]
+    return f"喵～{who}說話太快了，休息 {max(int(retry) + 1, 1)} 秒再找我吧！"
+
+# 決定唯一key（公會頻道用channel.id，私訊用對方的user.id；機器人自己在私訊送出的訊息也歸到同一個對話）
+def conversation_key(channel: discord.abc.Messageable, author_id: int) -> str:
+    if isinstance(channel, discord.DMChannel):
+        return f"dm_{channel.recipient.id if channel.recipient else author_id}"
+    return f"guild_{channel.id}"
+
+# 訊息分流：只用 O(1) 的判斷決定這則訊息是否需要完整處理
+ROUTE_PASSIVE = 0   # 不回覆（機器人訊息、未提及且不在自動聊天頻道）
+ROUTE_AUTOCHAT = 1  # 自動聊天頻道，合併後回覆
+ROUTE_MENTION = 2   # @提及，直接回覆
+
+def triage(message: discord.Message) -> int:
+    if message.author.bot:  # 包含自己送出的訊息
+        return ROUTE_PASSIVE
+    if bot.user.mentioned_in(message):
+        return ROUTE_MENTION
+    if message.channel.id in AUTOCHAT_CHANNELS:
+        return ROUTE_AUTOCHAT
+    return ROUTE_PASSIVE
+
 # 定義一個函數來處理訊息並回覆
 @bot.event
 async def on_message(message: discord.Message):
     try:
+        # 被忽略的使用者：什麼都不做
+        if blocklist.is_ignored(message.author.id):
+            return
+
         # 如果是指令（以 prefix 開頭），就不回覆
         if message.content.startswith(bot.command_prefix):
             await bot.process_commands(message)
             return
         
-        # 決定唯一key（公會頻道用channel.id，私訊用user.id）
+        conv_key = conversation_key(message.channel, message.author.id)
+
+        route = triage(message)
+        limited = None
+        if route != ROUTE_PASSIVE:
+            # 多次警告的使用者限制回覆頻率，超過限流的訊息也不回覆（同樣當作不回覆的訊息處理）
+            if not blocklist.allow(message.author.id):
+                route = ROUTE_PASSIVE
+            else:
+                limited = rate_limiter.check(message.author.id, message.channel.id, message.guild.id if message.guild else None)
+                if limited is not None:
+                    notify = route == ROUTE_MENTION and rate_limiter.should_notify(message.author.id)
+                    route = ROUTE_PASSIVE
+
+        if route == ROUTE_PASSIVE:
+            # 不會回覆的訊息：只批次記錄，已在記憶體中的對話順便補上歷史
+            db.defer_append_message(message.id, message.channel.id, message.author.id, str(message.author.name),
+                                    message.content, message.created_at.timestamp())
+            conv = conversations.get(conv_key)
+            if conv is not None:
+                conv.add_history(message.id, message.author.id, str(message.author.name), message.content, message.created_at)
+            if limited is not None and notify:
+                await message.reply(rate_limit_text(limited, message), mention_author=False)  # 不呼叫 LLM 的簡短回覆
+            return
+
         if message.guild is None:
-            conv_key = f"dm_{message.author.id}"
-            db.upsert_channel(channel_id=message.author.id, channel_name=message.author.name, server_id=0) # 確保私訊頻道存在於資料庫
+            db.defer_upsert_channel(channel_id=message.channel.id, channel_name=message.author.name, server_id=0) # 確保私訊頻道存在於資料庫（與頻道記憶使用相同的 id）
         else:
-            conv_key = f"guild_{message.channel.id}"
-            db.upsert_server(server_id=message.guild.id, server_name=message.guild.name)  # 確保伺服器存在於資料庫
-            db.upsert_channel(channel_id=message.channel.id, channel_name=message.channel.name, server_id=message.guild.id) # 確保頻道存在於資料庫
-        db.upsert_user(user_id=message.author.id, user_name=message.author.name)  # 確保使用者存在於資料庫
+            db.defer_upsert_server(server_id=message.guild.id, server_name=message.guild.name)  # 確保伺服器存在於資料庫
+            db.defer_upsert_channel(channel_id=message.channel.id, channel_name=message.channel.name, server_id=message.guild.id) # 確保頻道存在於資料庫
+        db.defer_upsert_user(user_id=message.author.id, user_name=message.author.name)  # 確保使用者存在於資料庫（批次延後寫入）
 
         # 取得或建立對話物件
-        if conv_key not in conversations:
-            conversations[conv_key] = conversation()
-            conv:conversation = conversations[conv_key]
-            await conv.add_history_from_dc(message.channel)
-        else:
-            conv:conversation = conversations[conv_key]
-            conv.add_history(message.id, message.author.id, str(message.author.name), message.content, message.created_at.strftime("%Y/%m/%d %a. %H:%M"))
+        # 不在記憶體中時載入快照或建立新對話，再從本地訊息紀錄補上之後的歷史（同時到達的訊息共用同一次載入）
+        conv = await conversations.open(conv_key, lambda conv: conv.add_history_from_db(db, message.channel))
+        conv.add_history(message.id, message.author.id, str(message.author.name), message.content, message.created_at)
+        db.defer_append_message(message.id, message.channel.id, message.author.id, str(message.author.name),
+                                message.content, message.created_at.timestamp())  # 訊息紀錄（批次延後寫入）
 
-        if message.author == bot.user:
-            return
-        # 忽略來自機器人的訊息
-        if message.author.bot:
-            return
         # 更新記憶使用者、頻道和伺服器的剩餘次數
         conv.id_list_update()
         conv.add_memusers_id(message.author.id)
         conv.add_memchannels_id(message.channel.id)
         conv.add_memservers_id(message.guild.id) if message.guild else None
 
+        # 訊息提到了機器人或在自動聊天頻道中，進行回覆
+        print(f"收到訊息: {message.content} (來自 {message.author})")
+
+        await summarizer.add(message.channel.id, message.guild.id if message.guild else 0,
+                             f"{(message.created_at + timedelta(hours=8)).strftime('%Y/%m/%d %a. %H:%M')} id={message.author.id} name={message.author.name} : {message.content}")
+
+        if route == ROUTE_MENTION:
+            # @提及 不等待合併，直接回覆（已涵蓋同頻道尚未觸發的訊息）
+            autochat_debouncer.discard(conv_key)
+            priority = PRIORITY_DM if message.guild is None else PRIORITY_MENTION
+            if reply_scheduler.submit(conv_key, priority, lambda: generate_reply(conv, [message])) is None:
+                print(f"回覆佇列已滿，略過訊息 {message.id}")
+        else:
+            autochat_debouncer.submit(conv_key, message)
 
-        if bot.user.mentioned_in(message) or message.channel.id in AUTOCHAT_CHANNELS:
-            async with message.channel.typing():
-                # 如果訊息提到了機器人或在自動聊天頻道中，則進行回覆
-                print(f"收到訊息: {message.content} (來自 {message.author})")
-
-                global_contents.append(
-                    types.Content(
-                        role="user",
-                        parts=[
-                            types.Part.from_text(text=f"{(message.created_at + timedelta(hours=8)).strftime('%Y/%m/%d %a. %H:%M')} id={message.author.id} name={message.author.name} : {message.content}"),
-                        ],
-                    )
-                )
-
-                # 取得記憶
-                usermem = db.get_users_memories_from_list(conv.get_memusers_id()) if conv.get_memusers_id() else None
-                channelmem = db.get_channels_memories_from_list(conv.get_memchannels_id()) if conv.get_memchannels_id() else None
-                
-                serverset1:set = set(conv.get_memservers_id()) if conv.get_memservers_id() == [] else set()
-                serverset2:set = set(db.get_servers_list_from_channels_list(conv.get_memchannels_id())) if conv.get_memchannels_id() else set()
-                merged_set:set = serverset1.union(serverset2)
-                memservers:list = list(merged_set)
-                servermem = db.get_servers_memories_from_list(memservers) if memservers else None
-
-                memory = f'server memories:\n{servermem}\nchannel memories:\n{channelmem}\nuser memories:\n{usermem}'
-
-                contents = []
-                contents.append(
-                    types.Content(
-                        role="model",
-                        parts=[
-                            types.Part.from_text(text=f"\n{long_term_memory}\n\n{memory}"),
-                            # types.Part.from_text(text=f"\nmemory\n\n{memory}\n\n")
-                        ],
-                    )
-                )
-
-                for msg in conv.history:
-                    role = "model" if msg['author_id'] == bot.user.id else "user"
-                    text = f"{msg['content']}" if msg['author_id'] == bot.user.id else f"{msg['timestamp']} id={msg['author_id']} name={msg['name']}: {msg['content']}"
-                    contents.append(
-                        types.Content(
-                        role=role,
-                        parts=[
-                            types.Part.from_text(text=text),
-                        ],
-                    ))
-                
-                # AI 回覆
-                client = genai.Client(api_key=CONFIG['Gemini_Token'])
-                model = CONFIG['model'] if 'model' in CONFIG else "gemini-2.5-flash"
-                generate_content_config = types.GenerateContentConfig(
-                    tools=[types.Tool(function_declarations=[add_important_memory_declatation])],
-                    system_instruction="你是個年齡不確定的貓娘,主要用正體中文,名字是CaTe像貓並參考元素表,身高130cm體重30kg,AquaNya是維護者,已使用帳號{bot.users}接入discord聊天,你將會收到許多資訊,回覆時不需包含這些格式,只需要針對用戶所說進行簡短對話。可以將重要的事情用Tool存下來。需要呼叫用戶時用 <@id> 。",
-                    response_mime_type="text/plain",
-                )
-                generate_content_config_text = types.GenerateContentConfig(
-                    system_instruction="你是個年齡不確定的貓娘,主要用正體中文,名字是CaTe像貓並參考元素表,身高130cm體重30kg,AquaNya是維護者,已使用帳號{bot.users}接入discord聊天,你將會收到許多資訊,回覆時不需包含這些格式,只需要針對用戶所說進行簡短對話。可以將重要的事情用Tool存下來。需要呼叫用戶時用 <@id> 。",
-                )
-
-                #AI 生成內容
-                print(contents)
-                response = client.models.generate_content(
-                    model=model,
-                    contents=contents,
-                    config=generate_content_config,
-                )
-
-                if response.candidates[0].content.parts[0].function_call:
-                    function_call = response.candidates[0].content.parts[0].function_call
-                    print(f"Function to call: {function_call.name}")
-                    print(f"Arguments: {function_call.args}")
-                    #  In a real app, you would call your function here:
-                    if function_call.name == "add_important_memory":
-                        scope = function_call.args.get("scope")
-                        content = function_call.args.get("content")
-                        reply_text = add_important_memory(message, scope, content)
-                        print(f"Function call result: {reply_text}")
-                        try:
-                            contents.append(
-                                types.Content(
-                                    role="model",
-                                    parts=[
-                                        types.Part.from_text(text=reply_text),
-                                    ],
-                                )
-                            )
-                            response = client.models.generate_content(
-                                model=model,
-                                contents=contents,
-                                config=generate_content_config_text,
-                            )
-                        except Exception as e:
-                            print(f"Gemini API 發生錯誤: {e}")
-                            response = f"喵喵喵？腦袋打結啦 {e}"
-                        finally:
-                            reply_text = f'{reply_text}\n{response.text}'
-
-                    else:
-                        print(f"未知的函數呼叫: {function_call.name}")
-                        reply_text = f"喵喵喵？未知的函數呼叫: {function_call.name}"
-                else:
-                    print("No function call found in the response.")
-                    print(response.text)
-                    reply_text = response.text
-
-                if reply_text:
-                    await send_in_chunks(message.channel, reply_text)
-                    global_contents.append(
-                        types.Content(
-                            role="model",
-                            parts=[
-                                types.Part.from_text(text=f"{str(time.strftime('%Y/%m/%d %a. %H:%M', time.localtime()))} id={message.author.id} name={message.author.name} : {message.content}")
-                            ],
-                        )
-                    )
-                else:
-                    await message.channel.send("喵喵喵？我不知道該怎麼回答喵！")           
-                
     except Exception as e:
         print(f"on_message 發生錯誤: {e}")
 
 
+# 訊息被編輯（包含串流回覆的逐步編輯）：更新訊息紀錄與記憶體中的歷史，之後的提示使用最終內容
+@bot.event
+async def on_raw_message_edit(payload: discord.RawMessageUpdateEvent):
+    try:
+        content = payload.data.get('content')
+        if content is None:  # 只有嵌入內容等變更
+            return
+        await db.update_message_content(payload.message_id, content)
+        channel = bot.get_channel(payload.channel_id)
+        if channel is None:
+            return
+        author_id = int(payload.data.get('author', {}).get('id', 0))
+        conv = conversations.get(conversation_key(channel, author_id))
+        if conv is not None:
+            conv.update_history(payload.message_id, content)
+    except Exception as e:
+        print(f"on_raw_message_edit 發生錯誤: {e}")
+
+
 # 設定指令
 class SettingsMenu(View):
     def __init__(self):
@@ -448,14 +643,14 @@ class SettingsSelect(Select):
             if interaction.channel.id in AUTOCHAT_CHANNELS:
                 await interaction.response.send_message("該頻道已經是聊天頻道！", ephemeral=True)
             else:
-                AUTOCHAT_CHANNELS.append(interaction.channel.id)
+                AUTOCHAT_CHANNELS.add(interaction.channel.id)
                 save_AUTOCHAT_CHANNELS(AUTOCHAT_CHANNELS)
                 await interaction.response.send_message(f"已成功新增 {interaction.channel.name} 為自動聊天頻道！", ephemeral=True)
         elif self.values[0] == "停止自動聊天":
             if interaction.channel.id not in AUTOCHAT_CHANNELS:
                 await interaction.response.send_message("該頻道不是聊天頻道！", ephemeral=True)
             else:
-                AUTOCHAT_CHANNELS.remove(interaction.channel.id)
+                AUTOCHAT_CHANNELS.discard(interaction.channel.id)
                 save_AUTOCHAT_CHANNELS(AUTOCHAT_CHANNELS)
                 await interaction.response.send_message(f"已成功移除 {interaction.channel.name} 的自動聊天功能！", ephemeral=True)
 
@@ -471,6 +666,48 @@ async def channel_settings(interaction: discord.Interaction):
     view = SettingsMenu()
     await interaction.response.send_message("請選擇設定操作：", view=view, ephemeral=True)
 
+@bot.tree.command(name="cate限流設定", description="查看或調整回覆的限流與每日 token 上限（Owner Only）")
+@app_commands.describe(scope="限流範圍", capacity="令牌桶容量（連續可觸發的回覆數，0 為不限制）",
+                       per_minute="每分鐘補充的回覆數", daily_tokens="每日 token 上限（0 為不限制）")
+@app_commands.choices(scope=[app_commands.Choice(name=scope, value=scope) for scope in RATE_SCOPES])
+async def rate_limit_settings(interaction: discord.Interaction, scope: Optional[str] = None, capacity: Optional[int] = None,
+                              per_minute: Optional[float] = None, daily_tokens: Optional[int] = None):
+    if interaction.user.id != int(CONFIG['Your_Discord_Id']):
+        await interaction.response.send_message("噗噗～沒有權限哦～", ephemeral=True)
+        return
+    if scope is not None and (capacity is not None or per_minute is not None):
+        current = rate_limiter.config()['rate_limits'].get(scope, {})
+        rate_limiter.set_limit(scope, capacity if capacity is not None else current.get('capacity', 0),
+                               per_minute if per_minute is not None else current.get('per_minute', 0))
+    if scope is not None and daily_tokens is not None:
+        rate_limiter.set_daily_tokens(scope, daily_tokens)
+    if scope is not None:
+        CONFIG.update(rate_limiter.config())
+        save_CONFIG()
+    status = {**rate_limiter.config(), 'tokens_today': rate_limiter.usage('global', 0)}
+    await interaction.response.send_message(f"```json\n{json.dumps(status, ensure_ascii=False, indent=2)}\n```", ephemeral=True)
+
+# 封鎖名單對所有伺服器生效，只有 Bot 擁有者可以調整
+@bot.tree.command(name="cate警告", description="警告使用者，累積次數後限制回覆頻率或忽略（Owner Only）")
+@app_commands.describe(user="要警告的使用者")
+async def warn_user(interaction: discord.Interaction, user: discord.User):
+    if interaction.user.id != int(CONFIG['Your_Discord_Id']):
+        await interaction.response.send_message("噗噗～沒有權限哦～", ephemeral=True)
+        return
+    await db.upsert_user(user_id=user.id, user_name=user.name)
+    result = await blocklist.warn(db, user.id)
+    await interaction.response.send_message(result, ephemeral=True)
+
+@bot.tree.command(name="cate忽略", description="忽略或取消忽略使用者（Owner Only）")
+@app_commands.describe(user="要設定的使用者", ignore="是否忽略")
+async def set_user_ignore(interaction: discord.Interaction, user: discord.User, ignore: bool = True):
+    if interaction.user.id != int(CONFIG['Your_Discord_Id']):
+        await interaction.response.send_message("噗噗～沒有權限哦～", ephemeral=True)
+        return
+    await db.upsert_user(user_id=user.id, user_name=user.name)
+    result = await db.ignore_user(user.id, ignore)
+    await interaction.response.send_message(result, ephemeral=True)
+
 @bot.tree.command(name="cate整理記憶", description="整理並新增長期記憶（Owner Only）")
 async def update_memory(interaction: discord.Interaction):
     if interaction.user.id != int(CONFIG['Your_Discord_Id']):
@@ -483,6 +720,27 @@ async def update_memory(interaction: discord.Interaction):
     except Exception as e:
         await interaction.followup.send(f"更新長期記憶時出錯: {e}", ephemeral=True)
 
+@bot.tree.command(name="cate狀態", description="查看排程佇列與快取狀態（Owner Only）")
+async def show_status(interaction: discord.Interaction):
+    if interaction.user.id != int(CONFIG['Your_Discord_Id']):
+        await interaction.response.send_message("噗噗～沒有權限哦～", ephemeral=True)
+        return
+    status = {
+        'reply_scheduler': reply_scheduler.stats(),
+        'autochat_debouncer': autochat_debouncer.stats(),
+        'gemini': gemini.stats(),
+        'tools': tool_registry.stats(),
+        'prompt': prompt_packer.stats(),
+        'prompt_renderer': prompt_renderer.stats(),
+        'summarizer': summarizer.stats(),
+        'summary_pipeline': summary_pipeline.last_run,
+        'entity_cache': db.cache_stats(),
+        'conversations': conversations.stats(),
+        'blocklist': blocklist.stats(),
+        'rate_limiter': rate_limiter.stats(),
+    }
+    await interaction.response.send_message(f"```json\n{json.dumps(status, ensure_ascii=False, indent=2)}\n```", ephemeral=True)
+
 # 每天凌晨3點定時整理記憶
 @tasks.loop(hours=1)
 async def reload_ai_loop():
@@ -490,15 +748,33 @@ async def reload_ai_loop():
         try:
             await update_long_term_memory()
         except Exception as e:
-            print(f'整理global_contents時出錯: {e}')
+            print(f'整理長期記憶時出錯: {e}')
+
+# 定時淘汰閒置的對話
+@tasks.loop(minutes=5)
+async def evict_conversations_loop():
+    try:
+        evicted = await conversations.evict_idle()
+        if evicted:
+            print(f'已淘汰 {evicted} 個閒置對話')
+    except Exception as e:
+        print(f'淘汰閒置對話時出錯: {e}')
+
+# 定時寫入 LLM 用量
+@tasks.loop(minutes=1)
+async def flush_usage_loop():
+    try:
+        await rate_limiter.flush(db)
+    except Exception as e:
+        print(f'寫入 LLM 用量時出錯: {e}')
 
 @bot.event
 async def on_ready():
     print(f'已登入為 {bot.user}')
     try:
         await bot.change_presence(status= discord.Status.online, activity=discord.Activity(type=discord.ActivityType.watching, name="CaTe聊天中..."))
-        global long_term_memory
-        long_term_memory = await get_long_term_memory()
+        await sync_long_term_memory()
+        await summarizer.start()
     except Exception as e:
         print(f'初始化時出錯: {e}')
     try:
@@ -508,6 +784,25 @@ async def on_ready():
         print(f'同步指令時出錯: {e}')
 
     reload_ai_loop.start()
+    if not evict_conversations_loop.is_running():
+        evict_conversations_loop.start()
+    if not flush_usage_loop.is_running():
+        flush_usage_loop.start()
 
 
-bot.run(TOKEN)
+async def main():
+    discord.utils.setup_logging()  # bot.run 預設的日誌設定
+    async with bot:
+        try:
+            await bot.start(TOKEN)
+        finally:
+            # 停止回覆 worker（進行中的回覆會被取消），再保存對話
+            await reply_scheduler.stop()
+
+try:
+    asyncio.run(main())
+except KeyboardInterrupt:
+    pass
+conversations.snapshot_all()
+db.db.add_llm_usage(rate_limiter.take_pending())
+db.close()
@@ -1,102 +1,669 @@
+import os
+import re
+import math
+import atexit
 import sqlite3
 import threading
-from datetime import datetime
-from typing import Optional, Any
+import asyncio
+import functools
+import pathlib
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Optional, Any, Iterator, Callable
+
+# 全文檢索用的 trigram 分詞器需要 SQLite 3.34 以上，能直接處理沒有空白分隔的正體中文
+FTS_AVAILABLE = sqlite3.sqlite_version_info >= (3, 34, 0)
+FTS_TABLES = ('user_memories', 'channel_memories', 'server_memories', 'core_memories')
+
+
+def fts_statements(table: str) -> list[str]:
+    """為記憶資料表建立外部內容的 FTS5 索引，並以 trigger 保持同步"""
+    fts = f'{table}_fts'
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(content, content='{table}', content_rowid='id', tokenize='trigram')",
+        f'''CREATE TRIGGER IF NOT EXISTS {table}_fts_ai AFTER INSERT ON {table} BEGIN
+            INSERT INTO {fts} (rowid, content) VALUES (new.id, new.content);
+        END''',
+        f'''CREATE TRIGGER IF NOT EXISTS {table}_fts_ad AFTER DELETE ON {table} BEGIN
+            INSERT INTO {fts} ({fts}, rowid, content) VALUES ('delete', old.id, old.content);
+        END''',
+        f'''CREATE TRIGGER IF NOT EXISTS {table}_fts_au AFTER UPDATE OF content ON {table} BEGIN
+            INSERT INTO {fts} ({fts}, rowid, content) VALUES ('delete', old.id, old.content);
+            INSERT INTO {fts} (rowid, content) VALUES (new.id, new.content);
+        END''',
+        f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')",
+    ]
+
+
+def fts_query(text: str, max_terms: int = 24) -> Optional[str]:
+    """把訊息轉成 FTS5 查詢：英數字詞整段比對，中日文等連續字串拆成 trigram，以 OR 連接"""
+    terms: list[str] = []
+    for chunk in re.findall(r'\w+', text or ''):
+        if len(chunk) < 3:  # trigram 無法比對少於 3 個字的片段
+            continue
+        if chunk.isascii():
+            terms.append(chunk)
+        else:
+            terms.extend(chunk[i:i + 3] for i in range(len(chunk) - 2))
+    terms = list(dict.fromkeys(terms))[:max_terms]
+    if not terms:
+        return None
+    return ' OR '.join('"' + term.replace('"', '""') + '"' for term in terms)
+
+
+# 資料庫結構遷移：(版本, 說明, SQL)，依序套用並記錄於 PRAGMA user_version
+# 只能在最後新增版本，已發佈的遷移不可修改
+MIGRATIONS: list[tuple[int, str, list[str]]] = [
+    (1, '建立基本資料表', [
+        # 建立 core_memories 表
+        '''
+            CREATE TABLE IF NOT EXISTS core_memories (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                content TEXT,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''',
+        # 建立 servers 表
+        '''
+            CREATE TABLE IF NOT EXISTS servers (
+                server_id INTEGER PRIMARY KEY,
+                server_name TEXT,
+                note TEXT,
+                api_key TEXT
+            )
+        ''',
+        # 建立 server_memories 表
+        '''
+            CREATE TABLE IF NOT EXISTS server_memories (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                server_id INTEGER,
+                content TEXT,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (server_id) REFERENCES servers(server_id) ON DELETE CASCADE
+            )
+        ''',
+        # 建立 channels 表
+        '''
+            CREATE TABLE IF NOT EXISTS channels (
+                channel_id INTEGER PRIMARY KEY,
+                channel_name TEXT,
+                note TEXT,
+                server_id INTEGER,
+                mode TEXT,
+                FOREIGN KEY (server_id) REFERENCES servers(server_id) ON DELETE CASCADE
+            )
+        ''',
+        # 建立 channel_memories 表
+        '''
+            CREATE TABLE IF NOT EXISTS channel_memories (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                channel_id INTEGER,
+                content TEXT,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (channel_id) REFERENCES channels(channel_id) ON DELETE CASCADE
+            )
+        ''',
+        # 建立 users 表
+        '''
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                user_name TEXT,
+                nickname TEXT,
+                birthday TEXT,  -- 格式：YYYY-MM-DD 或 --MM-DD
+                note TEXT,
+                api_key TEXT,
+                warning_count INTEGER DEFAULT 0,
+                ignore BOOLEAN DEFAULT FALSE
+            )
+        ''',
+        # 建立 user_memories 表
+        '''
+            CREATE TABLE IF NOT EXISTS user_memories (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                content TEXT,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+            )
+        ''',
+    ]),
+    (2, '記憶資料表與頻道的外鍵索引', [
+        'CREATE INDEX IF NOT EXISTS idx_user_memories_user ON user_memories (user_id, id DESC)',
+        'CREATE INDEX IF NOT EXISTS idx_channel_memories_channel ON channel_memories (channel_id, id DESC)',
+        'CREATE INDEX IF NOT EXISTS idx_server_memories_server ON server_memories (server_id, id DESC)',
+        'CREATE INDEX IF NOT EXISTS idx_channels_server ON channels (server_id)',
+    ]),
+    (3, '私訊頻道使用的伺服器 0（啟用外鍵後必須存在）', [
+        "INSERT OR IGNORE INTO servers (server_id, server_name) VALUES (0, '私訊')",
+    ]),
+    (4, '記憶全文檢索索引（FTS5 trigram）', [sql for table in FTS_TABLES for sql in fts_statements(table)] if FTS_AVAILABLE else []),
+    (5, '記憶向量（float32 BLOB）', [
+        '''
+            CREATE TABLE IF NOT EXISTS memory_embeddings (
+                scope TEXT NOT NULL,          -- user / channel / server / core
+                memory_id INTEGER NOT NULL,
+                owner_id INTEGER NOT NULL,    -- 核心記憶為 0
+                model TEXT NOT NULL,          -- 產生向量的 embedder，更換後會重新計算
+                vector BLOB NOT NULL,
+                PRIMARY KEY (scope, memory_id, model)
+            )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_memory_embeddings_owner ON memory_embeddings (model, scope, owner_id)',
+    ]),
+    (6, '對話快照（被淘汰或重新啟動時保存）', [
+        '''
+            CREATE TABLE IF NOT EXISTS conversation_snapshots (
+                conv_key TEXT PRIMARY KEY,
+                data TEXT NOT NULL,     -- JSON
+                updated_at REAL NOT NULL
+            )
+        ''',
+    ]),
+    (7, '訊息紀錄（頻道歷史改由本地讀取）', [
+        # msg_id 為 Discord snowflake，數值順序即時間順序；時間範圍查詢換算成 msg_id 範圍走同一個索引
+        '''
+            CREATE TABLE IF NOT EXISTS messages (
+                msg_id INTEGER PRIMARY KEY,
+                channel_id INTEGER NOT NULL,
+                author_id INTEGER NOT NULL,
+                author_name TEXT,
+                content TEXT,
+                created_at REAL NOT NULL    -- epoch 秒
+            )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_messages_channel ON messages (channel_id, msg_id)',
+    ]),
+    (8, '長期記憶頻道的本地鏡像', [
+        '''
+            CREATE TABLE IF NOT EXISTS long_term_memories (
+                msg_id INTEGER PRIMARY KEY,
+                channel_id INTEGER NOT NULL,
+                content TEXT NOT NULL,
+                created_at REAL NOT NULL    -- epoch 秒
+            )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_long_term_memories_channel ON long_term_memories (channel_id, msg_id)',
+    ]),
+    (9, '滾動摘要：待整理的對話片段與各頻道目前的摘要', [
+        '''
+            CREATE TABLE IF NOT EXISTS summary_segments (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                channel_id INTEGER NOT NULL,
+                server_id INTEGER,
+                content TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_summary_segments_channel ON summary_segments (channel_id, id)',
+        '''
+            CREATE TABLE IF NOT EXISTS rolling_summaries (
+                channel_id INTEGER PRIMARY KEY,
+                server_id INTEGER,
+                summary TEXT NOT NULL,
+                segments INTEGER NOT NULL DEFAULT 0,   -- 已併入摘要的片段數
+                updated_at REAL NOT NULL
+            )
+        ''',
+    ]),
+    (10, 'LLM 用量：每日各使用者、頻道、伺服器與全域的請求數與 token 數', [
+        '''
+            CREATE TABLE IF NOT EXISTS llm_usage (
+                day TEXT NOT NULL,          -- YYYY-MM-DD（本地時間）
+                scope TEXT NOT NULL,        -- user / channel / server / global
+                owner_id INTEGER NOT NULL,  -- global 為 0
+                requests INTEGER NOT NULL DEFAULT 0,
+                prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                output_tokens INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, scope, owner_id)
+            )
+        ''',
+    ]),
+]
+
+# Discord snowflake 的起算時間（毫秒），snowflake 的高位元為自此起算的毫秒數
+DISCORD_EPOCH_MS = 1420070400000
+
+
+def time_to_snowflake(timestamp: float, high: bool = False) -> int:
+    """把 epoch 秒換算成該毫秒最小（high 時為最大）的 snowflake"""
+    snowflake = max(int(timestamp * 1000) - DISCORD_EPOCH_MS, 0) << 22
+    return snowflake + (1 << 22) - 1 if high else snowflake
+
+# 全文檢索範圍：記憶資料表與擁有者欄位（核心記憶沒有擁有者）
+SEARCH_SCOPES = {
+    'user': ('user_memories', 'user_id'),
+    'channel': ('channel_memories', 'channel_id'),
+    'server': ('server_memories', 'server_id'),
+    'core': ('core_memories', None),
+}
+
+# 記憶範圍：(實體資料表, 記憶資料表, 主鍵欄位, 對外回傳的實體欄位, 預設筆數)
+MEMORY_SCOPES = {
+    'user': ('users', 'user_memories', 'user_id', ('user_id', 'user_name', 'nickname', 'birthday', 'note'), 5),
+    'channel': ('channels', 'channel_memories', 'channel_id', ('channel_id', 'channel_name', 'note', 'server_id'), 10),
+    'server': ('servers', 'server_memories', 'server_id', ('server_id', 'server_name', 'note'), 10),
+}
+
+
+def bulk_memories_sql(scope: str, count: int) -> str:
+    """一次取回 count 個實體及各自最近 N 筆記憶的查詢（參數：id * count, id * count, N）"""
+    table, mem_table, key, columns, _ = MEMORY_SCOPES[scope]
+    marks = ', '.join('?' * count)
+    return f'''
+        SELECT {', '.join('e.' + col for col in columns)}, m.id, m.content, m.timestamp
+        FROM {table} e
+        LEFT JOIN (
+            SELECT id, {key}, content, timestamp,
+                   ROW_NUMBER() OVER (PARTITION BY {key} ORDER BY id DESC) AS rn
+            FROM {mem_table}
+            WHERE {key} IN ({marks})
+        ) m ON m.{key} = e.{key} AND m.rn <= ?
+        WHERE e.{key} IN ({marks})
+        ORDER BY e.{key}, m.id
+    '''
+
+
+# 熱門查詢、查詢的記憶資料表與預期使用的索引，供 check_query_plans 檢查
+HOT_QUERIES = {
+    'user_memories': ("SELECT * FROM user_memories WHERE user_id = ? ORDER BY id DESC LIMIT 5", 'user_memories', 'idx_user_memories_user'),
+    'channel_memories': ("SELECT * FROM channel_memories WHERE channel_id = ? ORDER BY id DESC LIMIT 10", 'channel_memories', 'idx_channel_memories_channel'),
+    'server_memories': ("SELECT * FROM server_memories WHERE server_id = ? ORDER BY id DESC LIMIT 10", 'server_memories', 'idx_server_memories_server'),
+    'user_memories_bulk': (bulk_memories_sql('user', 1), 'user_memories', 'idx_user_memories_user'),
+    'channel_memories_bulk': (bulk_memories_sql('channel', 1), 'channel_memories', 'idx_channel_memories_channel'),
+    'server_memories_bulk': (bulk_memories_sql('server', 1), 'server_memories', 'idx_server_memories_server'),
+    'channel_messages': ('''
+        SELECT msg_id, author_id, author_name, content, created_at FROM messages
+        WHERE channel_id = ? AND msg_id > ? AND msg_id < ? ORDER BY msg_id DESC LIMIT ?
+    ''', 'messages', 'idx_messages_channel'),
+    'long_term_memories': ('''
+        SELECT msg_id, content, created_at FROM long_term_memories
+        WHERE channel_id = ? ORDER BY msg_id DESC LIMIT ?
+    ''', 'long_term_memories', 'idx_long_term_memories_channel'),
+}
+
+
+# 實體 upsert：以主鍵衝突轉為更新，未提供（None）的欄位保留原值
+UPSERT_SQL = {
+    'servers': (('server_id', 'server_name', 'note'), '''
+        INSERT INTO servers (server_id, server_name, note)
+        VALUES (?, ?, ?)
+        ON CONFLICT(server_id) DO UPDATE SET
+            server_name = COALESCE(excluded.server_name, server_name),
+            note = COALESCE(excluded.note, note)
+    '''),
+    'channels': (('channel_id', 'channel_name', 'note', 'server_id', 'mode'), '''
+        INSERT INTO channels (channel_id, channel_name, note, server_id, mode)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(channel_id) DO UPDATE SET
+            channel_name = COALESCE(excluded.channel_name, channel_name),
+            note = COALESCE(excluded.note, note),
+            server_id = COALESCE(excluded.server_id, server_id),
+            mode = COALESCE(excluded.mode, mode)
+    '''),
+    'users': (('user_id', 'user_name', 'nickname', 'birthday', 'note', 'api_key', 'warning_count', 'ignore'), '''
+        INSERT INTO users (user_id, user_name, nickname, birthday, note, api_key, warning_count, ignore)
+        VALUES (?, ?, ?, ?, ?, ?, COALESCE(?, 0), COALESCE(?, FALSE))
+        ON CONFLICT(user_id) DO UPDATE SET
+            user_name = COALESCE(excluded.user_name, user_name),
+            nickname = COALESCE(excluded.nickname, nickname),
+            birthday = COALESCE(excluded.birthday, birthday),
+            note = COALESCE(excluded.note, note),
+            api_key = COALESCE(excluded.api_key, api_key),
+            warning_count = COALESCE(?, warning_count),
+            ignore = COALESCE(?, ignore)
+    '''),
+    # 訊息紀錄只新增不修改，重複的 msg_id（例如補抓時重疊）直接略過
+    'messages': (('msg_id', 'channel_id', 'author_id', 'author_name', 'content', 'created_at'), '''
+        INSERT OR IGNORE INTO messages (msg_id, channel_id, author_id, author_name, content, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    '''),
+}
+
+
+# 各實體資料表的完整欄位（第一欄為主鍵），供快取與讀取使用
+ENTITY_COLUMNS = {
+    'servers': ('server_id', 'server_name', 'note', 'api_key'),
+    'channels': ('channel_id', 'channel_name', 'note', 'server_id', 'mode'),
+    'users': ('user_id', 'user_name', 'nickname', 'birthday', 'note', 'api_key', 'warning_count', 'ignore'),
+}
+
+
+def read_entities(conn: sqlite3.Connection, table: str, keys: list) -> list:
+    """以主鍵讀取整列實體 [(主鍵, 整列)]，每次查詢最多 500 個主鍵"""
+    columns = ENTITY_COLUMNS[table]
+    rows = []
+    for i in range(0, len(keys), 500):
+        chunk = keys[i:i + 500]
+        rows += [(found[0], dict(zip(columns, found))) for found in conn.execute(
+            f"SELECT {', '.join(columns)} FROM {table} WHERE {columns[0]} IN ({', '.join('?' * len(chunk))})", chunk)]
+    return rows
+
+
+class EntityCache:
+    """有上限的 LRU + TTL 快取，以 (資料表, 主鍵) 為 key 存放整列資料"""
+    def __init__(self, max_size: int = 10000, ttl: float = 300.0) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: OrderedDict[tuple[str, int], tuple[float, dict]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, table: str, key: int) -> Optional[dict]:
+        with self._lock:
+            item = self._data.get((table, key))
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._data[(table, key)]
+                self.misses += 1
+                return None
+            self._data.move_to_end((table, key))
+            self.hits += 1
+            return item[1]
+
+    def put(self, table: str, key: int, row: dict) -> None:
+        with self._lock:
+            self._data[(table, key)] = (time.monotonic() + self.ttl, row)
+            self._data.move_to_end((table, key))
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def merge(self, table: str, key: int, fields: dict) -> None:
+        """把非 None 的欄位合併進已快取的列（未快取則略過）"""
+        with self._lock:
+            item = self._data.get((table, key))
+            if item is not None:
+                item[1].update({k: v for k, v in fields.items() if v is not None})
+
+    def invalidate(self, table: str, key: int) -> None:
+        with self._lock:
+            self._data.pop((table, key), None)
+
+    def matches(self, table: str, key: int, fields: dict) -> bool:
+        """已快取的列是否已包含所有非 None 欄位的相同值"""
+        row = self.get(table, key)
+        if row is None:
+            return False
+        return all(row.get(k) == v for k, v in fields.items() if v is not None)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._data),
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
+# 寫回緩衝依外鍵順序寫入的資料表
+FLUSH_ORDER = ('servers', 'channels', 'users', 'messages')
+
+
+class WriteBehindBuffer:
+    """實體 upsert 的寫回緩衝
+
+    以 (資料表, 主鍵) 去重，同一筆的欄位以後寫入者為準（None 代表未提供，不覆蓋）。
+    累積數量達 max_pending 或每隔 flush_interval 秒，由背景執行緒以單一交易 executemany 寫入；
+    close() 或程式結束時保證寫入剩餘資料。
+    """
+    def __init__(self, db: 'DatabaseManager', max_pending: int = 256, flush_interval: float = 5.0) -> None:
+        self.db = db
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self._pending: dict[tuple[str, int], dict] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self.flush_count = 0
+        self._thread = threading.Thread(target=self._run, name='db-flush', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def put(self, table: str, key: int, fields: dict) -> None:
+        """加入一筆待寫入的 upsert，不會阻塞（超過門檻時交由背景執行緒寫入）"""
+        with self._lock:
+            merged = self._pending.setdefault((table, key), {})
+            merged.update({k: v for k, v in fields.items() if v is not None})
+            size = len(self._pending)
+        if size >= self.max_pending:
+            self._wake.set()
+
+    def has(self, table: str, key: int) -> bool:
+        return (table, key) in self._pending
+
+    def merge_pending(self, table: str, key: int, fields: dict) -> bool:
+        """若這筆仍在緩衝中就直接合併欄位並回傳 True（與 flush 互斥，不會在寫入途中遺失）"""
+        with self._lock:
+            merged = self._pending.get((table, key))
+            if merged is None:
+                return False
+            merged.update({k: v for k, v in fields.items() if v is not None})
+            return True
+
+    def has_table(self, table: str) -> bool:
+        with self._lock:
+            return any(pending_table == table for pending_table, _ in self._pending)
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def flush(self) -> int:
+        """把目前累積的 upsert 一次寫入，回傳寫入筆數"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                pending, self._pending = self._pending, {}
+            batches: dict[str, list] = {}
+            for (table, key), fields in pending.items():
+                batches.setdefault(table, []).append(self._row(table, key, fields))
+            try:
+                with self.db._writing() as conn:
+                    # 依外鍵順序寫入：伺服器 -> 頻道 -> 使用者，最後是訊息紀錄
+                    for table in FLUSH_ORDER:
+                        if table in batches:
+                            conn.executemany(UPSERT_SQL[table][1], batches[table])
+                    written = self._read_back(conn, batches)
+                self.flush_count += 1
+            except sqlite3.Error as e:
+                print(f"批次寫入 {len(pending)} 筆資料時發生錯誤，改為逐筆寫入: {e}")
+                return self._flush_rows(pending)
+            # 寫入後的整列放進快取，之後相同內容的延後寫入就不必再寫
+            for table, key, row in written:
+                if not self.has(table, key):  # 寫入期間又有新的延後寫入時不快取舊資料
+                    self.db.cache.put(table, key, row)
+            return len(pending)
+
+    @staticmethod
+    def _row(table: str, key: int, fields: dict) -> list:
+        columns, _ = UPSERT_SQL[table]
+        row = [key] + [fields.get(col) for col in columns[1:]]
+        if table == 'users':
+            row += [fields.get('warning_count'), fields.get('ignore')]
+        return row
+
+    def _flush_rows(self, pending: dict) -> int:
+        """整批寫入失敗時逐筆寫入：違反約束的資料丟棄，其他錯誤（例如 database is locked）放回緩衝下次再寫"""
+        written = 0
+        retry = {}
+        for table in FLUSH_ORDER:
+            for (row_table, key), fields in pending.items():
+                if row_table != table:
+                    continue
+                try:
+                    with self.db._writing() as conn:
+                        conn.execute(UPSERT_SQL[table][1], self._row(table, key, fields))
+                    written += 1
+                    continue
+                except sqlite3.IntegrityError as e:
+                    print(f"寫入 {table} {key} 時違反約束，略過: {e}")
+                except sqlite3.Error as e:
+                    print(f"寫入 {table} {key} 時發生錯誤，稍後重試: {e}")
+                    retry[(table, key)] = fields
+                # 快取已先套用這筆變更，寫入失敗時需作廢
+                self.db.cache.invalidate(table, key)
+        if retry:
+            with self._lock:
+                for item, fields in retry.items():
+                    # 失敗期間又有新的延後寫入時，以較新的欄位為準
+                    newer = self._pending.get(item)
+                    self._pending[item] = {**fields, **newer} if newer else fields
+        return written
+
+    @staticmethod
+    def _read_back(conn: sqlite3.Connection, batches: dict) -> list:
+        """在同一個交易中讀回剛寫入的實體 [(資料表, 主鍵, 整列)]"""
+        return [(table, key, row) for table in ENTITY_COLUMNS
+                for key, row in read_entities(conn, table, [row[0] for row in batches.get(table, ())])]
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def close(self) -> None:
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._wake.set()
+        self._thread.join()
+        self.flush()
+        atexit.unregister(self.close)
+
 
 class DatabaseManager:
-    def __init__(self, db_file:str='memory.db') -> None:
+    def __init__(self, db_file:str='memory.db', cache_size_kb: int = 16384, mmap_size: int = 128 * 1024 * 1024,
+                 cached_statements: int = 256, write_buffer_size: int = 256, write_buffer_interval: float = 5.0,
+                 cache_max_size: int = 10000, cache_ttl: float = 300.0) -> None:
         self.db_file = db_file
-        self.lock = threading.Lock()
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        self.cached_statements = cached_statements
+        self.lock = threading.RLock()  # 保護唯一的寫入連線
+        self._local = threading.local()  # 每個執行緒各自的唯讀連線
+        self._read_conns: list = []
+        self._read_conns_lock = threading.Lock()
+        self.cache = EntityCache(cache_max_size, cache_ttl)
+        self.memory_listeners: list[Callable[[str, Optional[int], int, str], None]] = []
+        self.user_state_listeners: list[Callable[[int, int, bool], None]] = []
+        self._writer = self._open()
         self._init_db()
+        self._warn_query_plans()
+        self.write_buffer = WriteBehindBuffer(self, write_buffer_size, write_buffer_interval)
 
-    def _connect(self) -> sqlite3.Connection:
-        return sqlite3.connect(self.db_file)
+    def _open(self, readonly: bool = False) -> sqlite3.Connection:
+        """開啟連線並套用 pragma；唯讀連線以 URI mode=ro 開啟"""
+        if readonly:
+            uri = pathlib.Path(os.path.abspath(self.db_file)).as_uri() + '?mode=ro'
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=self.cached_statements)
+        else:
+            conn = sqlite3.connect(self.db_file, check_same_thread=False, cached_statements=self.cached_statements)
+            conn.execute('PRAGMA journal_mode=WAL')  # 讓讀取與寫入可同時進行
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA cache_size=-{int(self.cache_size_kb)}')
+        conn.execute(f'PRAGMA mmap_size={int(self.mmap_size)}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA foreign_keys=ON')
+        return conn
 
+    @contextmanager
+    def _writing(self) -> Iterator[sqlite3.Connection]:
+        """取得寫入連線，離開時 commit，發生例外時 rollback"""
+        with self.lock:
+            conn = self._writer
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+
+    @contextmanager
+    def _reading(self) -> Iterator[sqlite3.Connection]:
+        """取得目前執行緒的唯讀連線（記憶體資料庫則共用寫入連線）"""
+        if self.db_file == ':memory:':
+            with self.lock:
+                yield self._writer
+            return
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._open(readonly=True)
+            self._local.conn = conn
+            with self._read_conns_lock:
+                self._read_conns.append(conn)
+        yield conn
+
+    def close(self) -> None:
+        self.write_buffer.close()
+        with self._read_conns_lock:
+            for conn in self._read_conns:
+                conn.close()
+            self._read_conns.clear()
+        with self.lock:
+            self._writer.close()
 
-    def _init_db(self) -> None:
-        with self._connect() as conn:
-            c = conn.cursor()
-
-            # 建立 core_memories 表
-            c.execute('''
-                CREATE TABLE IF NOT EXISTS core_memories (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    content TEXT,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-
-            # 建立 servers 表
-            c.execute('''
-                CREATE TABLE IF NOT EXISTS servers (
-                    server_id INTEGER PRIMARY KEY,
-                    server_name TEXT,
-                    note TEXT,
-                    api_key TEXT
-                )
-            ''')
-
-            # 建立 server_memories 表
-            c.execute('''
-                CREATE TABLE IF NOT EXISTS server_memories (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    server_id INTEGER,
-                    content TEXT,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (server_id) REFERENCES servers(server_id) ON DELETE CASCADE
-                )
-            ''')
-
-            # 建立 channels 表
-            c.execute('''
-                CREATE TABLE IF NOT EXISTS channels (
-                    channel_id INTEGER PRIMARY KEY,
-                    channel_name TEXT,
-                    note TEXT,
-                    server_id INTEGER,
-                    mode TEXT,
-                    FOREIGN KEY (server_id) REFERENCES servers(server_id) ON DELETE CASCADE
-                )
-            ''')
-
-            # 建立 channel_memories 表
-            c.execute('''
-                CREATE TABLE IF NOT EXISTS channel_memories (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    channel_id INTEGER,
-                    content TEXT,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (channel_id) REFERENCES channels(channel_id) ON DELETE CASCADE
-                )
-            ''')
-
-            # 建立 users 表
-            c.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    user_name TEXT,
-                    nickname TEXT,
-                    birthday TEXT,  -- 格式：YYYY-MM-DD 或 --MM-DD
-                    note TEXT,
-                    api_key TEXT,
-                    warning_count INTEGER DEFAULT 0,
-                    ignore BOOLEAN DEFAULT FALSE
-                )
-            ''')
-
-            # 建立 user_memories 表
-            c.execute('''
-                CREATE TABLE IF NOT EXISTS user_memories (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    content TEXT,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
-                )
-            ''')
 
+    def _init_db(self) -> None:
+        """依 PRAGMA user_version 依序套用尚未套用的遷移，每個遷移各自為一個交易"""
+        with self._writing() as conn:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            for target, description, statements in MIGRATIONS:
+                if target <= version:
+                    continue
+                conn.execute('BEGIN')
+                for sql in statements:
+                    conn.execute(sql)
+                conn.execute(f'PRAGMA user_version = {int(target)}')
+                conn.commit()
+                print(f"已套用資料庫遷移 {target}: {description}")
+            self.fts_enabled = self._has_fts(conn)
+            if not self.fts_enabled and FTS_AVAILABLE:
+                # 在舊版 SQLite 上套用的遷移 4 沒有建立 FTS；升級後在這裡補建並以現有記憶重建索引
+                try:
+                    conn.execute('BEGIN')
+                    for sql in (sql for table in FTS_TABLES for sql in fts_statements(table)):
+                        conn.execute(sql)
+                    conn.commit()
+                    print("已補建記憶全文檢索索引（FTS5 trigram）")
+                except sqlite3.Error as e:
+                    conn.rollback()
+                    print(f"補建記憶全文檢索索引時發生錯誤: {e}")
+                self.fts_enabled = self._has_fts(conn)
+            if not self.fts_enabled:
+                print(f"SQLite {sqlite3.sqlite_version} 不支援 trigram 全文檢索，相關記憶搜尋將停用。")
             print("資料庫初始化完成。")
 
+    @staticmethod
+    def _has_fts(conn: sqlite3.Connection) -> bool:
+        return conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_memories_fts'").fetchone() is not None
+
+    def check_query_plans(self) -> dict:
+        """以 EXPLAIN QUERY PLAN 確認熱門查詢都以索引搜尋，出現全表掃描時拋出 AssertionError"""
+        plans = {}
+        with self._reading() as conn:
+            for name, (sql, table, index) in HOT_QUERIES.items():
+                params = (0,) * sql.count('?')
+                detail = ' | '.join(row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params))
+                plans[name] = detail
+                assert f'USING INDEX {index}' in detail and f'SCAN {table}' not in detail, f"查詢 {name} 未使用索引 {index}: {detail}"
+        return plans
+
+    def _warn_query_plans(self) -> None:
+        # 啟動時檢查一次：熱門查詢退化成全表掃描時只警告，不影響啟動
+        try:
+            self.check_query_plans()
+        except AssertionError as e:
+            print(f"警告: {e}")
+        except sqlite3.Error as e:
+            print(f"檢查查詢計畫時發生錯誤: {e}")
+
 
     def _format_birthday(self, birthday: str) -> Optional[str]:
         if not birthday:
@@ -110,75 +677,189 @@ class DatabaseManager:
         return None
 
 
+    def _defer_upsert(self, table: str, key: int, fields: dict) -> None:
+        # 快取中的資料已相同就不寫入；否則先更新快取再交給寫回緩衝
+        if self.cache.matches(table, key, fields):
+            return
+        self.cache.merge(table, key, fields)
+        self.write_buffer.put(table, key, fields)
+
+    def defer_upsert_server(self, server_id: int, server_name: Optional[str] = None, note: Optional[str] = None) -> None:
+        """延後寫入的 upsert_server，由寫回緩衝批次寫入"""
+        self._defer_upsert('servers', server_id, {'server_name': server_name, 'note': note})
+
+    def defer_upsert_channel(self, channel_id: int, channel_name: Optional[str] = None, note: Optional[str] = None,
+                             server_id: Optional[int] = None, mode: Optional[str] = None) -> None:
+        """延後寫入的 upsert_channel，由寫回緩衝批次寫入"""
+        self._defer_upsert('channels', channel_id, {'channel_name': channel_name, 'note': note, 'server_id': server_id, 'mode': mode})
+
+    def defer_upsert_user(self, user_id: int, user_name: Optional[str] = None, nickname: Optional[str] = None,
+                          birthday: Optional[str] = None, note: Optional[str] = None) -> None:
+        """延後寫入的 upsert_user，由寫回緩衝批次寫入"""
+        self._defer_upsert('users', user_id, {'user_name': user_name, 'nickname': nickname,
+                                              'birthday': self._format_birthday(birthday), 'note': note})
+
+    def _get_entity(self, table: str, key: int) -> Optional[dict]:
+        """讀取整列實體資料：先查快取，未命中才查詢資料庫並寫入快取"""
+        row = self.cache.get(table, key)
+        if row is not None:
+            return row
+        self._flush_if_pending(table, key)
+        columns = ENTITY_COLUMNS[table]
+        with self._reading() as conn:
+            found = conn.execute(f"SELECT {', '.join(columns)} FROM {table} WHERE {columns[0]} = ?", (key,)).fetchone()
+        if found is None:
+            return None
+        row = dict(zip(columns, found))
+        if not self.write_buffer.has(table, key):  # 查詢期間又有新的延後寫入時不快取舊資料
+            self.cache.put(table, key, row)
+        return row
+
+    def defer_append_message(self, msg_id: int, channel_id: int, author_id: int, author_name: Optional[str],
+                             content: Optional[str], created_at: float) -> None:
+        """延後寫入一則訊息紀錄，與實體 upsert 一起由寫回緩衝批次寫入"""
+        self.write_buffer.put('messages', msg_id, {'channel_id': channel_id, 'author_id': author_id,
+                                                   'author_name': author_name, 'content': content, 'created_at': created_at})
+
+    def cache_stats(self) -> dict:
+        """實體快取的命中統計"""
+        return self.cache.stats()
+
+    def _cache_written(self, conn: sqlite3.Connection, table: str, key: int) -> None:
+        # 直接寫入後以資料庫中的實際值（COALESCE 後）更新快取
+        for _, row in read_entities(conn, table, [key]):
+            if not self.write_buffer.has(table, key):
+                self.cache.put(table, key, row)
+
+    def _flush_if_pending(self, table: str, key: int) -> None:
+        # 讀取或直接寫入某實體前，先把它尚未寫入的 upsert 寫入，維持讀寫順序
+        if self.write_buffer.has(table, key):
+            self.write_buffer.flush()
+
+    def flush_writes(self) -> int:
+        """立即寫入寫回緩衝中的資料"""
+        return self.write_buffer.flush()
+
+    def add_memory_listener(self, listener: Callable[[str, Optional[int], int, str], None]) -> None:
+        """註冊新增記憶後的回呼 listener(scope, owner_id, memory_id, content)，在 commit 後於寫入的執行緒呼叫"""
+        self.memory_listeners.append(listener)
+
+    def add_user_state_listener(self, listener: Callable[[int, int, bool], None]) -> None:
+        """註冊使用者警告次數或忽略狀態改變後的回呼 listener(user_id, warning_count, ignore)，在 commit 後於寫入的執行緒呼叫"""
+        self.user_state_listeners.append(listener)
+
+    def _notify_user_state(self, user_id: int) -> None:
+        if not self.user_state_listeners:
+            return
+        try:
+            with self._writing() as conn:
+                row = conn.execute("SELECT warning_count, ignore FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        except sqlite3.Error as e:
+            print(f"讀取使用者 {user_id} 的狀態時發生錯誤: {e}")
+            return
+        if row is None:
+            return
+        for listener in self.user_state_listeners:
+            try:
+                listener(user_id, row[0] or 0, bool(row[1]))
+            except Exception as e:
+                print(f"使用者狀態回呼 {listener} 發生錯誤: {e}")
+
+    def get_moderated_users(self) -> list:
+        """有警告或被忽略的使用者 [(user_id, warning_count, ignore)]，供啟動時建立封鎖名單"""
+        try:
+            with self._reading() as conn:
+                return [(user_id, warning_count or 0, bool(ignore)) for user_id, warning_count, ignore in conn.execute(
+                    "SELECT user_id, warning_count, ignore FROM users WHERE ignore OR warning_count > 0")]
+        except sqlite3.Error as e:
+            print(f"讀取封鎖名單時發生錯誤: {e}")
+            return []
+
+    def _notify_memory_added(self, scope: str, owner_id: Optional[int], memory_id: int, content: str) -> None:
+        for listener in self.memory_listeners:
+            try:
+                listener(scope, owner_id, memory_id, content)
+            except Exception as e:
+                print(f"記憶回呼 {listener} 發生錯誤: {e}")
+
     def add_core_memory(self, content: str) -> str:
         try:
-            with self._connect() as conn:
+            with self._writing() as conn:
                 conn: sqlite3.Connection
                 c = conn.cursor()
                 c.execute('''
                     INSERT INTO core_memories (content)
                     VALUES (?)
                 ''', (content,))
-                conn.commit()
-                return "已新增核心記憶。"
+                memory_id = c.lastrowid
+            self._notify_memory_added('core', None, memory_id, content)
+            return "已新增核心記憶。"
         except sqlite3.Error as e:
             return f"新增核心記憶時發生錯誤: {e}"
 
 
     def upsert_server(self, server_id: int, server_name: str, note: Optional[str] = None) -> str:
+        if self.cache.matches('servers', server_id, {'server_name': server_name, 'note': note}):
+            return f"伺服器 {server_id} 沒有變更。"
+        self._flush_if_pending('servers', server_id)
+        self.cache.invalidate('servers', server_id)
         try:
-            with self._connect() as conn:
+            with self._writing() as conn:
                 conn: sqlite3.Connection
                 c = conn.cursor()
-                c.execute('''
-                    INSERT INTO servers (server_id, server_name, note)
-                    VALUES (?, ?, ?)
-                ''', (server_id, server_name, note))
-                conn.commit()
-                return f"已新增伺服器 {server_id}。"
+                c.execute(UPSERT_SQL['servers'][1], (server_id, server_name, note))
+                self._cache_written(conn, 'servers', server_id)
+                return f"已新增或更新伺服器 {server_id}。"
         except sqlite3.Error as e:
-            return f"新增伺服器 {server_id} 時發生錯誤: {e}"
+            self.cache.invalidate('servers', server_id)  # 交易未完成，已放入快取的列不可信
+            return f"新增或更新伺服器 {server_id} 時發生錯誤: {e}"
 
     def add_server_memory(self, server_id: int, content: str) -> str:
+        self._flush_if_pending('servers', server_id)
         try:
-            with self._connect() as conn:
+            with self._writing() as conn:
                 conn: sqlite3.Connection
                 c = conn.cursor()
                 c.execute('''
                     INSERT INTO server_memories (server_id, content)
                     VALUES (?, ?)
                 ''', (server_id, content))
-                conn.commit()
-                return f"已新增伺服器 {server_id} 的記憶。"
+                memory_id = c.lastrowid
+            self._notify_memory_added('server', server_id, memory_id, content)
+            return f"已新增伺服器 {server_id} 的記憶。"
         except sqlite3.Error as e:
             return f"新增伺服器 {server_id} 的記憶時發生錯誤: {e}"
 
 
     def upsert_channel(self, channel_id: int, channel_name: str = None, note: Optional[str] = None, server_id: int = None,mode: Optional[str] = None) -> str:
+        if self.cache.matches('channels', channel_id, {'channel_name': channel_name, 'note': note, 'server_id': server_id, 'mode': mode}):
+            return f"頻道 {channel_id} 沒有變更。"
+        self._flush_if_pending('channels', channel_id)
+        self.cache.invalidate('channels', channel_id)
         try:
-            with self._connect() as conn:
+            with self._writing() as conn:
                 conn: sqlite3.Connection
                 c = conn.cursor()
-                c.execute('''
-                    INSERT INTO channels (channel_id, channel_name, note, server_id, mode)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (channel_id, channel_name, note, server_id, mode))
-                conn.commit()
-                return f"已新增頻道 {channel_id}。"
+                c.execute(UPSERT_SQL['channels'][1], (channel_id, channel_name, note, server_id, mode))
+                self._cache_written(conn, 'channels', channel_id)
+                return f"已新增或更新頻道 {channel_id}。"
         except sqlite3.Error as e:
-            return f"新增頻道 {channel_id} 時發生錯誤: {e}"
+            self.cache.invalidate('channels', channel_id)  # 交易未完成，已放入快取的列不可信
+            return f"新增或更新頻道 {channel_id} 時發生錯誤: {e}"
 
     def add_channel_memory(self, channel_id: int, content: str) -> str:
+        self._flush_if_pending('channels', channel_id)
         try:
-            with self._connect() as conn:
+            with self._writing() as conn:
                 conn: sqlite3.Connection
                 c = conn.cursor()
                 c.execute('''
                     INSERT INTO channel_memories (channel_id, content)
                     VALUES (?, ?)
                 ''', (channel_id, content))
-                conn.commit()
-                return f"已新增頻道 {channel_id} 的記憶。"
+                memory_id = c.lastrowid
+            self._notify_memory_added('channel', channel_id, memory_id, content)
+            return f"已新增頻道 {channel_id} 的記憶。"
         except sqlite3.Error as e:
             return f"新增頻道 {channel_id} 的記憶時發生錯誤: {e}"
 
@@ -187,8 +868,13 @@ class DatabaseManager:
                         birthday: Optional[str] = None, note: Optional[str] = None, api_key: Optional[str] = None,
                         warning_count: int = None, ignore: bool = None) -> str:
         birthday = self._format_birthday(birthday)
+        if self.cache.matches('users', user_id, {'user_name': user_name, 'nickname': nickname, 'birthday': birthday, 'note': note,
+                                                 'api_key': api_key, 'warning_count': warning_count, 'ignore': ignore}):
+            return f"使用者 {user_id} 沒有變更"
+        self._flush_if_pending('users', user_id)
+        self.cache.invalidate('users', user_id)  # COALESCE 更新後的實際值以資料庫為準
         try:
-            with self._connect() as conn:
+            with self._writing() as conn:
                 conn: sqlite3.Connection
                 c = conn.cursor()
 
@@ -209,22 +895,27 @@ class DatabaseManager:
                             ignore = COALESCE(?, ignore)
                         WHERE user_id = ?
                     ''', (user_name, nickname, birthday, note, api_key, warning_count, ignore, user_id))
-                    conn.commit()
-                    return f"已更新使用者 {user_id}"
+                    result = f"已更新使用者 {user_id}"
                 else:
                     # 新增
                     c.execute('''
                         INSERT INTO users (user_id, user_name, nickname, birthday, note, api_key, warning_count, ignore)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                        VALUES (?, ?, ?, ?, ?, ?, COALESCE(?, 0), COALESCE(?, FALSE))
                     ''', (user_id, user_name, nickname, birthday, note, api_key, warning_count, ignore))
-                    conn.commit()
-                    return f"已新增使用者 {user_id}"
+                    result = f"已新增使用者 {user_id}"
+                self._cache_written(conn, 'users', user_id)
         except sqlite3.Error as e:
+            self.cache.invalidate('users', user_id)  # 交易未完成，已放入快取的列不可信
             return f"新增或更新使用者 {user_id} 時發生錯誤: {e}"
+        if warning_count is not None or ignore is not None:
+            self._notify_user_state(user_id)
+        return result
 
     def add_user_warning(self, user_id: int):
+        self._flush_if_pending('users', user_id)
+        self.cache.invalidate('users', user_id)
         try:
-            with self._connect() as conn:
+            with self._writing() as conn:
                 conn: sqlite3.Connection
                 c = conn.cursor()
                 c.execute('''
@@ -232,14 +923,16 @@ class DatabaseManager:
                     SET warning_count = warning_count + 1
                     WHERE user_id = ?
                 ''', (user_id,))
-                conn.commit()
-                return f"已為使用者 {user_id} 增加警告。"
         except sqlite3.Error as e:
             return f"增加使用者 {user_id} 的警告時發生錯誤: {e}"
+        self._notify_user_state(user_id)
+        return f"已為使用者 {user_id} 增加警告。"
     
     def ignore_user(self, user_id: int, ignore: bool):
+        self._flush_if_pending('users', user_id)
+        self.cache.invalidate('users', user_id)
         try:
-            with self._connect() as conn:
+            with self._writing() as conn:
                 conn: sqlite3.Connection
                 c = conn.cursor()
                 c.execute('''
@@ -247,30 +940,32 @@ class DatabaseManager:
                     SET ignore = ?
                     WHERE user_id = ?
                 ''', (ignore, user_id))
-                conn.commit()
-                return f"已{'忽略' if ignore else '取消忽略'}使用者 {user_id}。"
         except sqlite3.Error as e:
             return f"更新使用者 {user_id} 忽略狀態時發生錯誤: {e}"
+        self._notify_user_state(user_id)
+        return f"已{'忽略' if ignore else '取消忽略'}使用者 {user_id}。"
 
     def add_user_memory(self, user_id: int, content: str):
-            try:
-                with self._connect() as conn:
-                    conn: sqlite3.Connection
-                    c = conn.cursor()
+        self._flush_if_pending('users', user_id)
+        try:
+            with self._writing() as conn:
+                conn: sqlite3.Connection
+                c = conn.cursor()
                 # 插入 user_memory
                 c.execute('''
                     INSERT INTO user_memories (user_id, content)
                     VALUES (?, ?)
                 ''', (user_id, content))
-                conn.commit()
-                return f"已新增使用者 {user_id} 的記憶。"
-            except sqlite3.Error as e:
-                return f"新增使用者 {user_id} 的記憶時發生錯誤: {e}"
+                memory_id = c.lastrowid
+            self._notify_memory_added('user', user_id, memory_id, content)
+            return f"已新增使用者 {user_id} 的記憶。"
+        except sqlite3.Error as e:
+            return f"新增使用者 {user_id} 的記憶時發生錯誤: {e}"
 
 
     def get_user_api_key(self, user_id: int) -> Optional[str]:
         try:
-            with self._connect() as conn:
+            with self._reading() as conn:
                 conn: sqlite3.Connection
                 c = conn.cursor()
                 c.execute("SELECT api_key FROM users WHERE user_id = ?", (user_id,))
@@ -284,7 +979,7 @@ class DatabaseManager:
 
     def get_server_api_key(self, server_id: int) -> Optional[str]:
         try:
-            with self._connect() as conn:
+            with self._reading() as conn:
                 conn: sqlite3.Connection
                 c = conn.cursor()
                 c.execute("SELECT api_key FROM servers WHERE server_id = ?", (server_id,))
@@ -298,11 +993,11 @@ class DatabaseManager:
 
     def get_user_memories(self, user_id: int) -> Optional[list]:
         try:
-            with self._connect() as conn:
+            with self._reading() as conn:
                 conn: sqlite3.Connection
                 c = conn.cursor()
                 c.execute(
-                    "SELECT * FROM user_memories WHERE user_id = ? ORDER BY id DESC LIMIT 5", (user_id,))
+                    HOT_QUERIES['user_memories'][0], (user_id,))
                 rows = c.fetchall()
                 rows = rows[::-1]  # 反轉順序，最新的在最前面
                 return [{'content': row[2], 'timestamp': row[3]} for row in rows]
@@ -312,21 +1007,16 @@ class DatabaseManager:
 
     def get_user(self, user_id: int) -> Optional[dict]:
         try:
-            with self._connect() as conn:
-                conn: sqlite3.Connection
-                c = conn.cursor()
-                c.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-                row = c.fetchone()
-                memories = self.get_user_memories(user_id)
-                if row:
-                    return {
-                        'user_id': row[0],
-                        'user_name': row[1],
-                        'nickname': row[2],
-                        'birthday': row[3],
-                        'note': row[4],
-                    }
-                return None
+            row = self._get_entity('users', user_id)
+            if row:
+                return {
+                    'user_id': row['user_id'],
+                    'user_name': row['user_name'],
+                    'nickname': row['nickname'],
+                    'birthday': row['birthday'],
+                    'note': row['note'],
+                }
+            return None
         except sqlite3.Error as e:
             print(f"查詢使用者 {user_id} 時發生錯誤: {e}")
             return None
@@ -334,11 +1024,11 @@ class DatabaseManager:
 
     def get_server_memories(self, server_id: int) -> Optional[list]:
         try:
-            with self._connect() as conn:
+            with self._reading() as conn:
                 conn: sqlite3.Connection
                 c = conn.cursor()
                 c.execute(
-                    "SELECT * FROM server_memories WHERE server_id = ? ORDER BY id DESC LIMIT 10", (server_id,))
+                    HOT_QUERIES['server_memories'][0], (server_id,))
                 rows = c.fetchall()
                 rows = rows[::-1]  # 反轉順序，最新的在最前面
                 return [{'content': row[2], 'timestamp': row[3]} for row in rows]
@@ -348,29 +1038,25 @@ class DatabaseManager:
 
     def get_server(self, server_id: int) -> Optional[dict]:
         try:
-            with self._connect() as conn:
-                conn: sqlite3.Connection
-                c = conn.cursor()
-                c.execute("SELECT * FROM servers WHERE server_id = ?", (server_id,))
-                row = c.fetchone()
-                if row:
-                    return {
-                        'server_id': row[0],
-                        'server_name': row[1],
-                        'note': row[2],
-                    }
-                return None
+            row = self._get_entity('servers', server_id)
+            if row:
+                return {
+                    'server_id': row['server_id'],
+                    'server_name': row['server_name'],
+                    'note': row['note'],
+                }
+            return None
         except sqlite3.Error as e:
             print(f"查詢伺服器 {server_id} 時發生錯誤: {e}")
             return None
 
     def get_channel_memories(self, channel_id: int) -> Optional[list]:
         try:
-            with self._connect() as conn:
+            with self._reading() as conn:
                 conn: sqlite3.Connection
                 c = conn.cursor()
                 c.execute(
-                    "SELECT * FROM channel_memories WHERE channel_id = ? ORDER BY id DESC LIMIT 10", (channel_id,))
+                    HOT_QUERIES['channel_memories'][0], (channel_id,))
                 rows = c.fetchall()
                 rows = rows[::-1]  # 反轉順序，最新的在最前面
                 return [{'content': row[2], 'timestamp': row[3]} for row in rows]
@@ -380,26 +1066,22 @@ class DatabaseManager:
 
     def get_channel(self, channel_id: int) -> Optional[dict]:
         try:
-            with self._connect() as conn:
-                conn: sqlite3.Connection
-                c = conn.cursor()
-                c.execute("SELECT * FROM channels WHERE channel_id = ?", (channel_id,))
-                row = c.fetchone()
-                if row:
-                    return {
-                        'channel_id': row[0],
-                        'channel_name': row[1],
-                        'note': row[2],
-                        'server_id': row[3],
-                    }
-                return None
+            row = self._get_entity('channels', channel_id)
+            if row:
+                return {
+                    'channel_id': row['channel_id'],
+                    'channel_name': row['channel_name'],
+                    'note': row['note'],
+                    'server_id': row['server_id'],
+                }
+            return None
         except sqlite3.Error as e:
             print(f"查詢頻道 {channel_id} 時發生錯誤: {e}")
             return None
 
     def get_core_memories(self) -> Optional[list]:
         try:
-            with self._connect() as conn:
+            with self._reading() as conn:
                 conn: sqlite3.Connection
                 c = conn.cursor()
                 c.execute("SELECT * FROM core_memories ORDER BY id DESC LIMIT 10")
@@ -412,21 +1094,17 @@ class DatabaseManager:
 
     def get_serverid_by_channel(self, channel_id: int) -> Optional[int]:
         try:
-            with self._connect() as conn:
-                conn: sqlite3.Connection
-                c = conn.cursor()
-                c.execute("SELECT server_id FROM channels WHERE channel_id = ?", (channel_id,))
-                row = c.fetchone()
-                if row:
-                    return row[0]
-                return None
+            row = self._get_entity('channels', channel_id)
+            if row:
+                return row['server_id']
+            return None
         except sqlite3.Error as e:
             print(f"查詢頻道 {channel_id} 的伺服器 ID 時發生錯誤: {e}")
             return None
 
     def get_user_and_memories(self, user_id: int) -> Optional[dict]:
         try:
-            with self._connect() as conn:
+            with self._reading() as conn:
                 conn: sqlite3.Connection
                 c = conn.cursor()
                 c.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
@@ -450,7 +1128,7 @@ class DatabaseManager:
 
     def get_channel_and_memories(self, channel_id: int) -> Optional[dict]:
         try:
-            with self._connect() as conn:
+            with self._reading() as conn:
                 conn: sqlite3.Connection
                 c = conn.cursor()
                 c.execute("SELECT * FROM channels WHERE channel_id = ?", (channel_id,))
@@ -473,7 +1151,7 @@ class DatabaseManager:
     
     def get_server_and_memories(self, server_id: int) -> Optional[dict]:
         try:
-            with self._connect() as conn:
+            with self._reading() as conn:
                 conn: sqlite3.Connection
                 c = conn.cursor()
                 c.execute("SELECT * FROM servers WHERE server_id = ?", (server_id,))
@@ -493,25 +1171,450 @@ class DatabaseManager:
             print(f"查詢伺服器 {server_id} 和記憶時發生錯誤: {e}")
             return None
 
+    def _get_with_memories(self, scope: str, ids: list, limit: Optional[int] = None,
+                           conn: Optional[sqlite3.Connection] = None) -> list:
+        """以單一查詢取回多個實體與各自最近 limit 筆記憶，依 ids 順序回傳（不存在的實體略過）"""
+        table, _, key, columns, default_limit = MEMORY_SCOPES[scope]
+        ids = list(dict.fromkeys(ids))
+        for id in ids:
+            if not isinstance(id, int):
+                raise ValueError(f"Invalid {key}: {id}. Must be an integer.")
+            self._flush_if_pending(table, id)
+        if not ids:
+            return []
+        params = (*ids, limit or default_limit, *ids)
+        if conn is None:
+            with self._reading() as conn:
+                rows = conn.execute(bulk_memories_sql(scope, len(ids)), params).fetchall()
+        else:
+            rows = conn.execute(bulk_memories_sql(scope, len(ids)), params).fetchall()
+        found: dict[int, dict] = {}
+        width = len(columns)
+        for row in rows:
+            entity = found.get(row[0])
+            if entity is None:
+                entity = found[row[0]] = dict(zip(columns, row[:width]))
+                entity['memories'] = []
+            if row[width] is not None:
+                entity['memories'].append({'id': row[width], 'content': row[width + 1], 'timestamp': row[width + 2]})
+        return [found[id] for id in ids if id in found]
+
+    def get_users_with_memories(self, user_ids: list, limit: int = 5) -> list:
+        """取回多位使用者資料與各自最近的記憶（舊到新）"""
+        try:
+            return self._get_with_memories('user', user_ids, limit)
+        except sqlite3.Error as e:
+            print(f"查詢使用者 {user_ids} 和記憶時發生錯誤: {e}")
+            return []
+
+    def get_channels_with_memories(self, channel_ids: list, limit: int = 10) -> list:
+        """取回多個頻道資料與各自最近的記憶（舊到新）"""
+        try:
+            return self._get_with_memories('channel', channel_ids, limit)
+        except sqlite3.Error as e:
+            print(f"查詢頻道 {channel_ids} 和記憶時發生錯誤: {e}")
+            return []
+
+    def get_servers_with_memories(self, server_ids: list, limit: int = 10) -> list:
+        """取回多個伺服器資料與各自最近的記憶（舊到新）"""
+        try:
+            return self._get_with_memories('server', server_ids, limit)
+        except sqlite3.Error as e:
+            print(f"查詢伺服器 {server_ids} 和記憶時發生錯誤: {e}")
+            return []
+
+    def save_conversation_snapshots(self, snapshots: list) -> None:
+        """保存對話快照，snapshots 為 [(conv_key, json_text)]"""
+        if not snapshots:
+            return
+        now = time.time()
+        try:
+            with self._writing() as conn:
+                conn.executemany('''
+                    INSERT OR REPLACE INTO conversation_snapshots (conv_key, data, updated_at)
+                    VALUES (?, ?, ?)
+                ''', [(key, data, now) for key, data in snapshots])
+        except sqlite3.Error as e:
+            print(f"保存 {len(snapshots)} 個對話快照時發生錯誤: {e}")
+
+    def load_conversation_snapshot(self, conv_key: str) -> Optional[str]:
+        try:
+            with self._reading() as conn:
+                row = conn.execute("SELECT data FROM conversation_snapshots WHERE conv_key = ?", (conv_key,)).fetchone()
+                return row[0] if row else None
+        except sqlite3.Error as e:
+            print(f"讀取對話 {conv_key} 的快照時發生錯誤: {e}")
+            return None
+
+    def append_messages(self, rows: list) -> int:
+        """直接寫入多則訊息紀錄 [(msg_id, channel_id, author_id, author_name, content, created_at)]，回傳新增筆數"""
+        if not rows:
+            return 0
+        try:
+            with self._writing() as conn:
+                before = conn.total_changes
+                conn.executemany(UPSERT_SQL['messages'][1], rows)
+                return conn.total_changes - before
+        except sqlite3.Error as e:
+            print(f"寫入 {len(rows)} 則訊息紀錄時發生錯誤: {e}")
+            return 0
+
+    def get_messages(self, channel_id: int, limit: Optional[int] = 30, after_id: Optional[int] = None,
+                     before_id: Optional[int] = None, since: Optional[float] = None,
+                     until: Optional[float] = None) -> list:
+        """讀取頻道的訊息紀錄 [(msg_id, author_id, author_name, content, created_at)]，由舊到新
+
+        after_id / before_id 為不含端點的 msg_id 範圍，since / until 為含端點的 epoch 秒；
+        有 limit 時只取範圍內最新的 limit 則。
+        """
+        if self.write_buffer.has_table('messages'):
+            self.write_buffer.flush()
+        low, high = after_id or 0, before_id or (1 << 63) - 1
+        if since is not None:
+            low = max(low, time_to_snowflake(since) - 1)
+        if until is not None:
+            high = min(high, time_to_snowflake(until, high=True) + 1)
+        try:
+            with self._reading() as conn:
+                rows = conn.execute(HOT_QUERIES['channel_messages'][0],
+                                    (channel_id, low, high, -1 if limit is None else limit)).fetchall()
+                rows.reverse()
+                return rows
+        except sqlite3.Error as e:
+            print(f"讀取頻道 {channel_id} 的訊息紀錄時發生錯誤: {e}")
+            return []
+
+    def update_message_content(self, msg_id: int, content: str) -> None:
+        """訊息被編輯後更新紀錄中的內容（INSERT OR IGNORE 不會覆蓋已記錄的訊息）"""
+        if self.write_buffer.merge_pending('messages', msg_id, {'content': content}):
+            return
+        try:
+            with self._writing() as conn:
+                conn.execute("UPDATE messages SET content = ? WHERE msg_id = ?", (content, msg_id))
+        except sqlite3.Error as e:
+            print(f"更新訊息 {msg_id} 的內容時發生錯誤: {e}")
+
+    def get_last_message_id(self, channel_id: int) -> Optional[int]:
+        """頻道中已記錄的最新 msg_id，向 Discord 補抓時只需要抓這之後的訊息"""
+        if self.write_buffer.has_table('messages'):
+            self.write_buffer.flush()
+        try:
+            with self._reading() as conn:
+                return conn.execute("SELECT MAX(msg_id) FROM messages WHERE channel_id = ?", (channel_id,)).fetchone()[0]
+        except sqlite3.Error as e:
+            print(f"讀取頻道 {channel_id} 的最新訊息 id 時發生錯誤: {e}")
+            return None
+
+    def save_long_term_memories(self, rows: list) -> int:
+        """寫入長期記憶頻道的訊息 [(msg_id, channel_id, content, created_at)]，已存在的 msg_id 以新內容為準"""
+        if not rows:
+            return 0
+        try:
+            with self._writing() as conn:
+                conn.executemany('''
+                    INSERT OR REPLACE INTO long_term_memories (msg_id, channel_id, content, created_at)
+                    VALUES (?, ?, ?, ?)
+                ''', rows)
+            return len(rows)
+        except sqlite3.Error as e:
+            print(f"寫入 {len(rows)} 則長期記憶時發生錯誤: {e}")
+            return 0
+
+    def get_long_term_memories(self, channel_id: int, limit: int = 100) -> list:
+        """長期記憶頻道中最新的 limit 則 [(msg_id, content, created_at)]，由舊到新"""
+        try:
+            with self._reading() as conn:
+                rows = conn.execute(HOT_QUERIES['long_term_memories'][0], (channel_id, limit)).fetchall()
+                rows.reverse()
+                return rows
+        except sqlite3.Error as e:
+            print(f"讀取長期記憶時發生錯誤: {e}")
+            return []
+
+    def get_last_long_term_memory_id(self, channel_id: int) -> Optional[int]:
+        try:
+            with self._reading() as conn:
+                return conn.execute("SELECT MAX(msg_id) FROM long_term_memories WHERE channel_id = ?", (channel_id,)).fetchone()[0]
+        except sqlite3.Error as e:
+            print(f"讀取長期記憶的最新訊息 id 時發生錯誤: {e}")
+            return None
+
+    def add_summary_segments(self, rows: list) -> None:
+        """寫入待摘要的對話片段 [(channel_id, server_id, content, created_at)]"""
+        if not rows:
+            return
+        try:
+            with self._writing() as conn:
+                conn.executemany("INSERT INTO summary_segments (channel_id, server_id, content, created_at) VALUES (?, ?, ?, ?)", rows)
+        except sqlite3.Error as e:
+            print(f"寫入 {len(rows)} 個摘要片段時發生錯誤: {e}")
+
+    def get_summary_segments(self, channel_id: int, limit: int = -1) -> list:
+        """頻道中尚未併入摘要的片段 [(id, server_id, content)]，由舊到新"""
+        try:
+            with self._reading() as conn:
+                return conn.execute(
+                    "SELECT id, server_id, content FROM summary_segments WHERE channel_id = ? ORDER BY id LIMIT ?",
+                    (channel_id, limit)).fetchall()
+        except sqlite3.Error as e:
+            print(f"讀取頻道 {channel_id} 的摘要片段時發生錯誤: {e}")
+            return []
+
+    def get_pending_summary_counts(self) -> list:
+        """各頻道待摘要的片段數與字數 [(channel_id, count, chars)]"""
+        try:
+            with self._reading() as conn:
+                return conn.execute(
+                    "SELECT channel_id, COUNT(*), SUM(LENGTH(content)) FROM summary_segments GROUP BY channel_id").fetchall()
+        except sqlite3.Error as e:
+            print(f"讀取待摘要片段數量時發生錯誤: {e}")
+            return []
+
+    def get_rolling_summary(self, channel_id: int) -> Optional[str]:
+        try:
+            with self._reading() as conn:
+                row = conn.execute("SELECT summary FROM rolling_summaries WHERE channel_id = ?", (channel_id,)).fetchone()
+                return row[0] if row else None
+        except sqlite3.Error as e:
+            print(f"讀取頻道 {channel_id} 的摘要時發生錯誤: {e}")
+            return None
+
+    def save_rolling_summary(self, channel_id: int, server_id: Optional[int], summary: str, through_id: int) -> bool:
+        """以單一交易更新頻道摘要並刪除已併入的片段（id <= through_id）"""
+        try:
+            with self._writing() as conn:
+                deleted = conn.execute("DELETE FROM summary_segments WHERE channel_id = ? AND id <= ?",
+                                       (channel_id, through_id)).rowcount
+                conn.execute('''
+                    INSERT INTO rolling_summaries (channel_id, server_id, summary, segments, updated_at)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(channel_id) DO UPDATE SET
+                        server_id = COALESCE(excluded.server_id, server_id),
+                        summary = excluded.summary,
+                        segments = segments + excluded.segments,
+                        updated_at = excluded.updated_at
+                ''', (channel_id, server_id, summary, deleted, time.time()))
+            return True
+        except sqlite3.Error as e:
+            print(f"保存頻道 {channel_id} 的摘要時發生錯誤: {e}")
+            return False
+
+    def get_rolling_summaries(self) -> list:
+        """所有頻道目前的摘要 [(channel_id, server_id, summary, updated_at)]"""
+        try:
+            with self._reading() as conn:
+                return conn.execute(
+                    "SELECT channel_id, server_id, summary, updated_at FROM rolling_summaries ORDER BY server_id, channel_id").fetchall()
+        except sqlite3.Error as e:
+            print(f"讀取頻道摘要時發生錯誤: {e}")
+            return []
+
+    def clear_rolling_summaries(self, summaries: list) -> None:
+        """刪除已整理進長期記憶的摘要 [(channel_id, updated_at)]；之後又更新過的摘要保留"""
+        try:
+            with self._writing() as conn:
+                conn.executemany("DELETE FROM rolling_summaries WHERE channel_id = ? AND updated_at = ?", summaries)
+        except sqlite3.Error as e:
+            print(f"刪除頻道摘要時發生錯誤: {e}")
+
+    def add_llm_usage(self, rows: list) -> bool:
+        """累加 LLM 用量 [(day, scope, owner_id, requests, prompt_tokens, output_tokens)]"""
+        if not rows:
+            return True
+        try:
+            with self._writing() as conn:
+                conn.executemany('''
+                    INSERT INTO llm_usage (day, scope, owner_id, requests, prompt_tokens, output_tokens)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (day, scope, owner_id) DO UPDATE SET
+                        requests = requests + excluded.requests,
+                        prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                        output_tokens = output_tokens + excluded.output_tokens
+                ''', rows)
+            return True
+        except sqlite3.Error as e:
+            print(f"寫入 {len(rows)} 筆 LLM 用量時發生錯誤: {e}")
+            return False
+
+    def get_llm_usage(self, day: str) -> list:
+        """某一天的 LLM 用量 [(scope, owner_id, requests, prompt_tokens, output_tokens)]"""
+        try:
+            with self._reading() as conn:
+                return conn.execute(
+                    "SELECT scope, owner_id, requests, prompt_tokens, output_tokens FROM llm_usage WHERE day = ?",
+                    (day,)).fetchall()
+        except sqlite3.Error as e:
+            print(f"讀取 {day} 的 LLM 用量時發生錯誤: {e}")
+            return []
+
+    def get_memories_by_ids(self, scope: str, memory_ids: list) -> list:
+        """依記憶 id 取回記憶內容 [{'id', 'owner_id', 'content', 'timestamp'}]，依 memory_ids 順序"""
+        table, key = SEARCH_SCOPES[scope]
+        if not memory_ids:
+            return []
+        try:
+            with self._reading() as conn:
+                rows = conn.execute(f'''
+                    SELECT id, {key or 'NULL'}, content, timestamp FROM {table}
+                    WHERE id IN ({', '.join('?' * len(memory_ids))})
+                ''', list(memory_ids)).fetchall()
+        except sqlite3.Error as e:
+            print(f"查詢{scope}記憶 {memory_ids} 時發生錯誤: {e}")
+            return []
+        found = {row[0]: {'id': row[0], 'owner_id': row[1], 'content': row[2], 'timestamp': row[3]} for row in rows}
+        return [found[id] for id in memory_ids if id in found]
+
+    def save_embeddings(self, scope: str, model: str, rows: list) -> None:
+        """儲存記憶向量，rows 為 [(memory_id, owner_id, vector_blob)]"""
+        try:
+            with self._writing() as conn:
+                conn.executemany('''
+                    INSERT OR REPLACE INTO memory_embeddings (scope, memory_id, owner_id, model, vector)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', [(scope, memory_id, owner_id or 0, model, blob) for memory_id, owner_id, blob in rows])
+        except sqlite3.Error as e:
+            print(f"儲存{scope}記憶向量時發生錯誤: {e}")
+
+    def load_embeddings(self, scope: str, owner_id: Optional[int], model: str) -> tuple[list, list]:
+        """讀取某擁有者的記憶向量與尚未計算向量的記憶
+
+        回傳 ([(memory_id, vector_blob)], [(memory_id, content)])，已刪除的記憶不會出現。
+        """
+        table, key = SEARCH_SCOPES[scope]
+        owner_filter = f'm.{key} = ?' if key else '? = 0'
+        params = (model, scope, owner_id or 0)
+        try:
+            with self._reading() as conn:
+                vectors = conn.execute(f'''
+                    SELECT m.id, e.vector FROM {table} m
+                    JOIN memory_embeddings e ON e.memory_id = m.id AND e.model = ? AND e.scope = ?
+                    WHERE {owner_filter}
+                    ORDER BY m.id
+                ''', params).fetchall()
+                missing = conn.execute(f'''
+                    SELECT m.id, m.content FROM {table} m
+                    WHERE {owner_filter} AND NOT EXISTS (
+                        SELECT 1 FROM memory_embeddings e
+                        WHERE e.scope = ? AND e.memory_id = m.id AND e.model = ?
+                    )
+                    ORDER BY m.id
+                ''', (owner_id or 0, scope, model)).fetchall()
+            return vectors, missing
+        except sqlite3.Error as e:
+            print(f"讀取{scope}記憶向量時發生錯誤: {e}")
+            return [], []
+
+    def _search_memories(self, conn: sqlite3.Connection, query: str, scope: str, owner_ids: Optional[list],
+                         k: int, recency_weight: float, half_life_days: float) -> list:
+        table, key = SEARCH_SCOPES[scope]
+        match = fts_query(query)
+        if not self.fts_enabled or match is None or k <= 0:
+            return []
+        owner_ids = list(owner_ids or [])
+        if key and not owner_ids:
+            return []
+        owner_filter = f"AND m.{key} IN ({', '.join('?' * len(owner_ids))})" if key else ''
+        rows = conn.execute(f'''
+            SELECT m.id, {f'm.{key}' if key else 'NULL'}, m.content, m.timestamp, bm25({table}_fts) AS rank
+            FROM {table}_fts JOIN {table} m ON m.id = {table}_fts.rowid
+            WHERE {table}_fts MATCH ? {owner_filter}
+            ORDER BY rank
+            LIMIT ?
+        ''', (match, *(owner_ids if key else ()), k * 5)).fetchall()
+        if not rows:
+            return []
+        # bm25 越小越相關；正規化後與以半衰期計算的新舊程度加權混合
+        best = min(row[4] for row in rows)
+        now = datetime.now(timezone.utc)
+        results = []
+        for id, owner_id, content, timestamp, rank in rows:
+            relevance = rank / best if best else 0.0
+            try:
+                created = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+                age_days = max((now - created).total_seconds(), 0) / 86400
+            except (TypeError, ValueError):
+                age_days = 0.0
+            recency = math.pow(0.5, age_days / half_life_days)
+            score = (1 - recency_weight) * relevance + recency_weight * recency
+            results.append({'id': id, 'owner_id': owner_id, 'content': content, 'timestamp': timestamp, 'score': score})
+        results.sort(key=lambda r: r['score'], reverse=True)
+        return results[:k]
+
+    def search_memories(self, query: str, scope: str, owner_ids: Optional[list] = None, k: int = 5,
+                        recency_weight: float = 0.3, half_life_days: float = 30.0) -> list:
+        """以全文檢索找出與 query 最相關的 k 筆記憶（BM25 與新舊程度混合排序）
+
+        scope 為 'user'、'channel'、'server' 或 'core'；除 core 外需提供 owner_ids 限定擁有者。
+        """
+        try:
+            with self._reading() as conn:
+                return self._search_memories(conn, query, scope, owner_ids, k, recency_weight, half_life_days)
+        except sqlite3.Error as e:
+            print(f"搜尋{scope}記憶時發生錯誤: {e}")
+            return []
+
+    def get_conversation_context(self, user_ids: list, channel_ids: list, server_ids: Optional[list] = None,
+                                 user_limit: int = 5, channel_limit: int = 10, server_limit: int = 10,
+                                 query: Optional[str] = None, relevant_limit: int = 3) -> dict:
+        """在同一個讀取交易（一致的快照）中取回對話所需的使用者、頻道、伺服器資料與記憶
+
+        頻道所屬的伺服器以 join 解析後與 server_ids 合併；回傳 {'users', 'channels', 'servers', 'relevant', 'elapsed_ms'}。
+        有提供 query 時，'relevant' 為各範圍以全文檢索找到、且不在最近記憶中的相關記憶。
+        """
+        start = time.perf_counter()
+        user_ids, channel_ids, server_ids = list(user_ids or []), list(channel_ids or []), list(server_ids or [])
+        for table, ids in (('users', user_ids), ('channels', channel_ids), ('servers', server_ids)):
+            for id in ids:
+                self._flush_if_pending(table, id)
+        context = {'users': [], 'channels': [], 'servers': [], 'relevant': {}, 'elapsed_ms': 0.0}
+        try:
+            with self._reading() as conn:
+                conn.execute('BEGIN')
+                try:
+                    if channel_ids:
+                        rows = conn.execute(f'''
+                            SELECT DISTINCT c.server_id
+                            FROM channels c JOIN servers s ON s.server_id = c.server_id
+                            WHERE c.channel_id IN ({', '.join('?' * len(channel_ids))})
+                        ''', channel_ids).fetchall()
+                        server_ids += [row[0] for row in rows]
+                    context['users'] = self._get_with_memories('user', user_ids, user_limit, conn)
+                    context['channels'] = self._get_with_memories('channel', channel_ids, channel_limit, conn)
+                    context['servers'] = self._get_with_memories('server', server_ids, server_limit, conn)
+                    if query:
+                        owners = {'user': user_ids, 'channel': channel_ids, 'server': server_ids, 'core': None}
+                        for scope, entities in (('user', context['users']), ('channel', context['channels']),
+                                                ('server', context['servers']), ('core', [])):
+                            recent = {m['id'] for entity in entities for m in entity['memories']}
+                            found = self._search_memories(conn, query, scope, owners[scope], relevant_limit + len(recent), 0.3, 30.0)
+                            found = [m for m in found if m['id'] not in recent][:relevant_limit]
+                            if found:
+                                context['relevant'][scope] = found
+                finally:
+                    conn.commit()
+        except sqlite3.Error as e:
+            print(f"取得對話記憶時發生錯誤: {e}")
+        context['elapsed_ms'] = (time.perf_counter() - start) * 1000
+        return context
+
+    def _format_with_memories(self, entities: list) -> list:
+        # 舊版字串格式：實體 dict 後接記憶清單
+        formatted = []
+        for entity in entities:
+            entity = dict(entity)
+            memories = [{'content': m['content'], 'timestamp': m['timestamp']} for m in entity.pop('memories')]
+            formatted.append(f'{entity}memories: {memories}')
+        return formatted
+
     def get_users_memories_from_list(self, user_ids: list) -> list:
         if not user_ids:
             return []
-        memories:list = []
-        for id in user_ids:
-            if not isinstance(id, int):
-                raise ValueError(f"Invalid user_id: {id}. Must be an integer.")
-            memories.append(f'{self.get_user(id)}memories: {self.get_user_memories(id)}')
-        return memories
+        return self._format_with_memories(self.get_users_with_memories(user_ids))
 
     def get_channels_memories_from_list(self, channel_ids: list) -> list:
         if not channel_ids:
             return []
-        memories:list = []
-        for id in channel_ids:
-            if not isinstance(id, int):
-                raise ValueError(f"Invalid channel_id: {id}. Must be an integer.")
-            memories.append(f'{self.get_channel(id)}memories: {self.get_channel_memories(id)}')
-        return memories
+        return self._format_with_memories(self.get_channels_with_memories(channel_ids))
     
     def get_servers_list_from_channels_list(self, channel_ids: list) -> list:
         if not channel_ids:
@@ -528,12 +1631,214 @@ class DatabaseManager:
     def get_servers_memories_from_list(self, server_ids: list) -> list:
         if not server_ids:
             return []
-        memories:list = []
-        for id in server_ids:
-            if not isinstance(id, int):
-                raise ValueError(f"Invalid server_id: {id}. Must be an integer.")
-            memories.append(f'{self.get_server(id)}memories: {self.get_server_memories(id)}')
-        return memories
+        return self._format_with_memories(self.get_servers_with_memories(server_ids))
+
+
+class AsyncDatabaseManager:
+    """DatabaseManager 的 asyncio 版本：寫入走專用的單一寫入執行緒，讀取走讀取執行緒池，不阻塞事件迴圈"""
+    def __init__(self, db_file: str = 'memory.db', read_workers: int = 4, db: Optional[DatabaseManager] = None) -> None:
+        self.db = db or DatabaseManager(db_file)
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self._readers = ThreadPoolExecutor(max_workers=read_workers, thread_name_prefix='db-reader')
+
+    async def _write(self, func, *args, **kwargs) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, functools.partial(func, *args, **kwargs))
+
+    async def _read(self, func, *args, **kwargs) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, functools.partial(func, *args, **kwargs))
+
+    def close(self) -> None:
+        # 等待尚未完成的寫入全部落地
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        self.db.close()
+
+    # 寫入
+    async def add_core_memory(self, content: str) -> str:
+        return await self._write(self.db.add_core_memory, content)
+
+    async def upsert_server(self, server_id: int, server_name: str, note: Optional[str] = None) -> str:
+        return await self._write(self.db.upsert_server, server_id, server_name, note)
+
+    async def add_server_memory(self, server_id: int, content: str) -> str:
+        return await self._write(self.db.add_server_memory, server_id, content)
+
+    async def upsert_channel(self, channel_id: int, channel_name: str = None, note: Optional[str] = None, server_id: int = None, mode: Optional[str] = None) -> str:
+        return await self._write(self.db.upsert_channel, channel_id, channel_name, note, server_id, mode)
+
+    async def add_channel_memory(self, channel_id: int, content: str) -> str:
+        return await self._write(self.db.add_channel_memory, channel_id, content)
+
+    async def upsert_user(self, user_id: int, user_name: Optional[str] = None, nickname: Optional[str] = None,
+                          birthday: Optional[str] = None, note: Optional[str] = None, api_key: Optional[str] = None,
+                          warning_count: int = None, ignore: bool = None) -> str:
+        return await self._write(self.db.upsert_user, user_id, user_name, nickname, birthday, note, api_key, warning_count, ignore)
+
+    async def add_user_warning(self, user_id: int) -> str:
+        return await self._write(self.db.add_user_warning, user_id)
+
+    async def ignore_user(self, user_id: int, ignore: bool) -> str:
+        return await self._write(self.db.ignore_user, user_id, ignore)
+
+    async def add_user_memory(self, user_id: int, content: str) -> str:
+        return await self._write(self.db.add_user_memory, user_id, content)
+
+    async def get_moderated_users(self) -> list:
+        return await self._read(self.db.get_moderated_users)
+
+    # 延後寫入：只更新記憶體中的緩衝，可直接在事件迴圈中呼叫
+    def defer_upsert_server(self, server_id: int, server_name: Optional[str] = None, note: Optional[str] = None) -> None:
+        self.db.defer_upsert_server(server_id, server_name, note)
+
+    def defer_upsert_channel(self, channel_id: int, channel_name: Optional[str] = None, note: Optional[str] = None,
+                             server_id: Optional[int] = None, mode: Optional[str] = None) -> None:
+        self.db.defer_upsert_channel(channel_id, channel_name, note, server_id, mode)
+
+    def defer_upsert_user(self, user_id: int, user_name: Optional[str] = None, nickname: Optional[str] = None,
+                          birthday: Optional[str] = None, note: Optional[str] = None) -> None:
+        self.db.defer_upsert_user(user_id, user_name, nickname, birthday, note)
+
+    def defer_append_message(self, msg_id: int, channel_id: int, author_id: int, author_name: Optional[str],
+                             content: Optional[str], created_at: float) -> None:
+        self.db.defer_append_message(msg_id, channel_id, author_id, author_name, content, created_at)
+
+    async def append_messages(self, rows: list) -> int:
+        return await self._write(self.db.append_messages, rows)
+
+    async def flush_writes(self) -> int:
+        return await self._write(self.db.flush_writes)
+
+    def cache_stats(self) -> dict:
+        return self.db.cache_stats()
+
+    # 讀取
+    async def get_user_api_key(self, user_id: int) -> Optional[str]:
+        return await self._read(self.db.get_user_api_key, user_id)
+
+    async def get_server_api_key(self, server_id: int) -> Optional[str]:
+        return await self._read(self.db.get_server_api_key, server_id)
+
+    async def get_user_memories(self, user_id: int) -> Optional[list]:
+        return await self._read(self.db.get_user_memories, user_id)
+
+    async def get_user(self, user_id: int) -> Optional[dict]:
+        return await self._read(self.db.get_user, user_id)
+
+    async def get_server_memories(self, server_id: int) -> Optional[list]:
+        return await self._read(self.db.get_server_memories, server_id)
+
+    async def get_server(self, server_id: int) -> Optional[dict]:
+        return await self._read(self.db.get_server, server_id)
+
+    async def get_channel_memories(self, channel_id: int) -> Optional[list]:
+        return await self._read(self.db.get_channel_memories, channel_id)
+
+    async def get_channel(self, channel_id: int) -> Optional[dict]:
+        return await self._read(self.db.get_channel, channel_id)
+
+    async def get_core_memories(self) -> Optional[list]:
+        return await self._read(self.db.get_core_memories)
+
+    async def get_serverid_by_channel(self, channel_id: int) -> Optional[int]:
+        return await self._read(self.db.get_serverid_by_channel, channel_id)
+
+    async def get_user_and_memories(self, user_id: int) -> Optional[dict]:
+        return await self._read(self.db.get_user_and_memories, user_id)
+
+    async def get_channel_and_memories(self, channel_id: int) -> Optional[dict]:
+        return await self._read(self.db.get_channel_and_memories, channel_id)
+
+    async def get_server_and_memories(self, server_id: int) -> Optional[dict]:
+        return await self._read(self.db.get_server_and_memories, server_id)
+
+    async def get_users_with_memories(self, user_ids: list, limit: int = 5) -> list:
+        return await self._read(self.db.get_users_with_memories, user_ids, limit)
+
+    async def get_channels_with_memories(self, channel_ids: list, limit: int = 10) -> list:
+        return await self._read(self.db.get_channels_with_memories, channel_ids, limit)
+
+    async def get_servers_with_memories(self, server_ids: list, limit: int = 10) -> list:
+        return await self._read(self.db.get_servers_with_memories, server_ids, limit)
+
+    async def get_conversation_context(self, user_ids: list, channel_ids: list, server_ids: Optional[list] = None,
+                                       user_limit: int = 5, channel_limit: int = 10, server_limit: int = 10,
+                                       query: Optional[str] = None, relevant_limit: int = 3) -> dict:
+        return await self._read(self.db.get_conversation_context, user_ids, channel_ids, server_ids,
+                                user_limit, channel_limit, server_limit, query, relevant_limit)
+
+    async def save_conversation_snapshots(self, snapshots: list) -> None:
+        return await self._write(self.db.save_conversation_snapshots, snapshots)
+
+    async def load_conversation_snapshot(self, conv_key: str) -> Optional[str]:
+        return await self._read(self.db.load_conversation_snapshot, conv_key)
+
+    async def get_messages(self, channel_id: int, limit: Optional[int] = 30, after_id: Optional[int] = None,
+                           before_id: Optional[int] = None, since: Optional[float] = None,
+                           until: Optional[float] = None) -> list:
+        return await self._read(self.db.get_messages, channel_id, limit, after_id, before_id, since, until)
+
+    async def update_message_content(self, msg_id: int, content: str) -> None:
+        return await self._write(self.db.update_message_content, msg_id, content)
+
+    async def get_last_message_id(self, channel_id: int) -> Optional[int]:
+        return await self._read(self.db.get_last_message_id, channel_id)
+
+    async def save_long_term_memories(self, rows: list) -> int:
+        return await self._write(self.db.save_long_term_memories, rows)
+
+    async def get_long_term_memories(self, channel_id: int, limit: int = 100) -> list:
+        return await self._read(self.db.get_long_term_memories, channel_id, limit)
+
+    async def get_last_long_term_memory_id(self, channel_id: int) -> Optional[int]:
+        return await self._read(self.db.get_last_long_term_memory_id, channel_id)
+
+    async def add_summary_segments(self, rows: list) -> None:
+        return await self._write(self.db.add_summary_segments, rows)
+
+    async def get_summary_segments(self, channel_id: int, limit: int = -1) -> list:
+        return await self._read(self.db.get_summary_segments, channel_id, limit)
+
+    async def get_pending_summary_counts(self) -> list:
+        return await self._read(self.db.get_pending_summary_counts)
+
+    async def get_rolling_summary(self, channel_id: int) -> Optional[str]:
+        return await self._read(self.db.get_rolling_summary, channel_id)
+
+    async def save_rolling_summary(self, channel_id: int, server_id: Optional[int], summary: str, through_id: int) -> bool:
+        return await self._write(self.db.save_rolling_summary, channel_id, server_id, summary, through_id)
+
+    async def get_rolling_summaries(self) -> list:
+        return await self._read(self.db.get_rolling_summaries)
+
+    async def clear_rolling_summaries(self, summaries: list) -> None:
+        return await self._write(self.db.clear_rolling_summaries, summaries)
+
+    async def add_llm_usage(self, rows: list) -> bool:
+        return await self._write(self.db.add_llm_usage, rows)
+
+    async def get_llm_usage(self, day: str) -> list:
+        return await self._read(self.db.get_llm_usage, day)
+
+    async def get_memories_by_ids(self, scope: str, memory_ids: list) -> list:
+        return await self._read(self.db.get_memories_by_ids, scope, memory_ids)
+
+    async def search_memories(self, query: str, scope: str, owner_ids: Optional[list] = None, k: int = 5,
+                              recency_weight: float = 0.3, half_life_days: float = 30.0) -> list:
+        return await self._read(self.db.search_memories, query, scope, owner_ids, k, recency_weight, half_life_days)
+
+    async def get_users_memories_from_list(self, user_ids: list) -> list:
+        return await self._read(self.db.get_users_memories_from_list, user_ids)
+
+    async def get_channels_memories_from_list(self, channel_ids: list) -> list:
+        return await self._read(self.db.get_channels_memories_from_list, channel_ids)
+
+    async def get_servers_list_from_channels_list(self, channel_ids: list) -> list:
+        return await self._read(self.db.get_servers_list_from_channels_list, channel_ids)
+
+    async def get_servers_memories_from_list(self, server_ids: list) -> list:
+        return await self._read(self.db.get_servers_memories_from_list, server_ids)
 
 if __name__ == '__main__':
 
@@ -573,4 +1878,5 @@ if __name__ == '__main__':
     # print(db.get_server(111111111111111114))
     user_ids = [111111111111111112, 111111111111111114]
     print(db.get_users_memories_from_list(user_ids))
+    print(db.check_query_plans())
     
\ No newline at end of file
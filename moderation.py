@@ -0,0 +1,79 @@
+import time
+import threading
+
+from memorydb import AsyncDatabaseManager
+
+
+class Blocklist:
+    """記憶體中的封鎖名單，依 users.ignore 與 warning_count 判斷是否處理訊息
+
+    啟動時從資料庫載入，之後由 DatabaseManager 的使用者狀態回呼同步；查詢都是 O(1)，
+    在任何資料庫或 LLM 工作之前就能擋下訊息。
+    警告達 throttle_warnings 次的使用者每 throttle_interval 秒只處理一則訊息，
+    達 ignore_warnings 次時自動改為忽略。
+    """
+    def __init__(self, throttle_warnings: int = 3, ignore_warnings: int = 5, throttle_interval: float = 60.0) -> None:
+        self.throttle_warnings = throttle_warnings
+        self.ignore_warnings = ignore_warnings
+        self.throttle_interval = throttle_interval
+        self._ignored: set[int] = set()
+        self._warnings: dict[int, int] = {}
+        self._last_allowed: dict[int, float] = {}
+        self._lock = threading.Lock()
+        self.rejected = 0
+        self.throttled = 0
+
+    def load(self, rows: list) -> None:
+        for user_id, warning_count, ignore in rows:
+            self.on_user_state(user_id, warning_count, ignore)
+
+    def on_user_state(self, user_id: int, warning_count: int, ignore: bool) -> None:
+        """DatabaseManager 的使用者狀態回呼（在寫入執行緒呼叫）"""
+        with self._lock:
+            if ignore:
+                self._ignored.add(user_id)
+            else:
+                self._ignored.discard(user_id)
+            if warning_count:
+                self._warnings[user_id] = warning_count
+            else:
+                self._warnings.pop(user_id, None)
+                self._last_allowed.pop(user_id, None)
+
+    def is_ignored(self, user_id: int) -> bool:
+        if user_id in self._ignored:
+            self.rejected += 1
+            return True
+        return False
+
+    def allow(self, user_id: int) -> bool:
+        """要完整處理（回覆）這則訊息前呼叫；被忽略或還在節流間隔內時回傳 False"""
+        if self.is_ignored(user_id):
+            return False
+        if self._warnings.get(user_id, 0) < self.throttle_warnings:
+            return True
+        now = time.monotonic()
+        if now - self._last_allowed.get(user_id, float('-inf')) < self.throttle_interval:
+            self.throttled += 1
+            return False
+        self._last_allowed[user_id] = now
+        return True
+
+    async def warn(self, db: AsyncDatabaseManager, user_id: int) -> str:
+        """增加警告並套用升級規則，回傳結果訊息"""
+        result = await db.add_user_warning(user_id)
+        warnings = self._warnings.get(user_id, 0)
+        if warnings >= self.ignore_warnings and user_id not in self._ignored:
+            result += await db.ignore_user(user_id, True)
+        elif warnings >= self.throttle_warnings:
+            result += f"（警告 {warnings} 次，已限制回覆頻率）"
+        return result
+
+    def stats(self) -> dict:
+        return {
+            'ignored': len(self._ignored),
+            'warned': len(self._warnings),
+            'throttled_users': sum(1 for count in self._warnings.values() if count >= self.throttle_warnings),
+            'rejected': self.rejected,
+            'throttled': self.throttled,
+        }
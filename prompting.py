@@ -0,0 +1,201 @@
+import re
+import time
+import calendar
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+# 中日韓文字、全形符號：Gemini 的 tokenizer 大約每個字一個 token
+CJK_RE = re.compile(r'[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]')
+
+
+def estimate_tokens(text: str) -> int:
+    """離線估算 token 數：中日韓文字每字約 1 token，其餘約每 4 個字元 1 token"""
+    if not text:
+        return 0
+    cjk = len(CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+class PackResult:
+    """一次打包的結果：各類別放入的 key、使用的 token 數與被略過的數量"""
+    __slots__ = ('included', 'used', 'budget', 'dropped', 'dropped_tokens')
+
+    def __init__(self, budget: int) -> None:
+        self.included: dict[str, set] = {}
+        self.used = 0
+        self.budget = budget
+        self.dropped: dict[str, int] = {}
+        self.dropped_tokens = 0
+
+    def has(self, kind: str, key: Hashable) -> bool:
+        return key in self.included.get(kind, ())
+
+    def report(self) -> str:
+        dropped = '、'.join(f'{kind} {count} 筆' for kind, count in self.dropped.items()) or '無'
+        return f'提示使用 {self.used}/{self.budget} tokens，略過：{dropped}（約 {self.dropped_tokens} tokens）'
+
+
+class ContextPacker:
+    """依優先序把提示內容裝進 token 預算
+
+    pack() 接收依優先序排列的 (類別, [(key, 文字)], 是否需連續[, token 總數上限])；同一類別內也依優先序排列。
+    需連續的類別（對話歷史）一旦有一筆放不下，之後較舊的也一律略過，避免歷史中間出現斷層。
+    對話歷史的 token 總數由 conversation 在新增、淘汰與編輯紀錄時累計（conversation.tokens），
+    整個類別放得下時直接全部放入，不逐筆估算；放不下時才逐筆挑選。
+    每段文字的估算結果以文字本身為 key 快取，對話歷史等跨回合不變的內容不會重複估算。
+    """
+    def __init__(self, budget: int = 8000, cache_size: int = 4096) -> None:
+        self.budget = budget
+        self.cache_size = cache_size
+        self._cache: OrderedDict[str, int] = OrderedDict()
+        self.last: PackResult | None = None
+        self.packs = 0
+        self.truncated = 0
+        self.whole = 0  # 依累計的總數整組放入、不需逐筆估算的次數
+
+    def tokens(self, text: str) -> int:
+        count = self._cache.get(text)
+        if count is None:
+            count = estimate_tokens(text)
+            self._cache[text] = count
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(text)
+        return count
+
+    def pack(self, groups: list) -> PackResult:
+        result = PackResult(self.budget)
+        for kind, items, contiguous, *total in groups:
+            included = result.included.setdefault(kind, set())
+            if total and total[0] is not None and result.used + total[0] <= self.budget:
+                included.update(key for key, _ in items)
+                result.used += total[0]
+                self.whole += 1
+                continue
+            full = False
+            for key, text in items:
+                count = self.tokens(text)
+                if not full and result.used + count <= self.budget:
+                    included.add(key)
+                    result.used += count
+                    continue
+                full = contiguous
+                result.dropped[kind] = result.dropped.get(kind, 0) + 1
+                result.dropped_tokens += count
+        self.packs += 1
+        if result.dropped:
+            self.truncated += 1
+        self.last = result
+        return result
+
+    def stats(self) -> dict:
+        return {
+            'budget': self.budget,
+            'packs': self.packs,
+            'truncated': self.truncated,
+            'whole_groups': self.whole,
+            'last': self.last.report() if self.last else None,
+            'cached_segments': len(self._cache),
+        }
+
+
+# 實體欄位在提示中的簡短名稱（主鍵放在標頭，不另外列出）
+FIELD_LABELS = {
+    'user_name': 'name', 'nickname': 'nick', 'birthday': 'birthday', 'note': 'note',
+    'channel_name': 'name', 'server_id': 'server', 'server_name': 'name',
+}
+
+
+def relative_time(timestamp: Optional[str], now: float) -> str:
+    """資料庫的 UTC 時間字串轉成簡短的相對時間：now、5m、3h、2d、4w、5mo、2y"""
+    if not timestamp:
+        return '?'
+    try:
+        seconds = now - calendar.timegm(time.strptime(timestamp, '%Y-%m-%d %H:%M:%S'))
+    except ValueError:
+        return timestamp
+    if seconds < 60:
+        return 'now'
+    for unit, size, limit in (('m', 60, 3600), ('h', 3600, 86400), ('d', 86400, 14 * 86400),
+                              ('w', 7 * 86400, 60 * 86400), ('mo', 30 * 86400, 365 * 86400)):
+        if seconds < limit:
+            return f'{int(seconds // size)}{unit}'
+    return f'{int(seconds // (365 * 86400))}y'
+
+
+def render_memory_lines(memories: list, now: float) -> list:
+    """記憶依時間由舊到新列出，相對時間相同的記憶共用一行的前綴"""
+    lines = []
+    label = None
+    for memory in memories:
+        current = relative_time(memory['timestamp'], now)
+        if current == label:
+            lines[-1] += f" / {memory['content']}"
+        else:
+            lines.append(f"- {current}: {memory['content']}")
+            label = current
+    return lines
+
+
+class PromptRenderer:
+    """把記憶紀錄轉成精簡、固定格式的提示文字（取代 dict / list 的 repr）
+
+    每個實體一個區塊：[scope id 欄位=值] 標頭後接記憶，時間以相對時間表示。
+    實體區塊依實體快取；新增記憶時由記憶回呼作廢，相對時間會隨時間改變，因此另有 ttl 秒的期限。
+    """
+    def __init__(self, ttl: float = 60.0) -> None:
+        self.ttl = ttl
+        self._entities: dict[tuple[str, int], tuple[float, tuple, str]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def on_memory_added(self, scope: str, owner_id: Optional[int], memory_id: int, content: str) -> None:
+        self._entities.pop((scope, owner_id), None)
+
+    def invalidate(self, scope: str, entity_id: int) -> None:
+        self._entities.pop((scope, entity_id), None)
+
+    @staticmethod
+    def header(scope: str, entity: dict) -> str:
+        fields = ' '.join(f'{FIELD_LABELS.get(key, key)}={value}' for key, value in entity.items()
+                          if key != f'{scope}_id' and key != 'memories' and key in FIELD_LABELS and value not in (None, ''))
+        return f"[{scope} {entity[f'{scope}_id']}{' ' + fields if fields else ''}]"
+
+    def render_entity(self, scope: str, entity: dict) -> str:
+        key = (scope, entity[f'{scope}_id'])
+        # 實體欄位或記憶有變動時快取也不適用
+        fingerprint = tuple(value for name, value in entity.items() if name != 'memories') \
+            + tuple(memory['id'] for memory in entity.get('memories', ()))
+        now = time.time()
+        cached = self._entities.get(key)
+        if cached and cached[0] > now and cached[1] == fingerprint:
+            self.hits += 1
+            return cached[2]
+        self.misses += 1
+        text = '\n'.join([self.header(scope, entity)] + render_memory_lines(entity.get('memories', []), now))
+        self._entities[key] = (now + self.ttl, fingerprint, text)
+        return text
+
+    @staticmethod
+    def render_memory(scope: str, memory: dict, now: Optional[float] = None) -> str:
+        owner = memory.get('owner_id')
+        return f"[{scope}{f' {owner}' if owner else ''}] {relative_time(memory['timestamp'], now or time.time())}: {memory['content']}"
+
+    def render_context(self, entities: list, memories: list) -> str:
+        """entities 為 [(scope, entity)]，memories 為 [(段落名稱, scope, memory)]；依段落分組輸出"""
+        now = time.time()
+        sections: dict[str, list] = {}
+        for scope, entity in entities:
+            sections.setdefault(f'{scope} memories', []).append(self.render_entity(scope, entity))
+        grouped: dict[str, dict[tuple, list]] = {}
+        for section, scope, memory in memories:
+            grouped.setdefault(section, {}).setdefault((scope, memory.get('owner_id')), []).append(memory)
+        for section, owners in grouped.items():
+            for (scope, owner), found in owners.items():
+                sections.setdefault(section, []).append(
+                    '\n'.join([f"[{scope}{f' {owner}' if owner else ''}]"] + render_memory_lines(found, now)))
+        return '\n'.join(f'## {section}\n' + '\n'.join(blocks) for section, blocks in sections.items())
+
+    def stats(self) -> dict:
+        return {'cached_entities': len(self._entities), 'hits': self.hits, 'misses': self.misses}
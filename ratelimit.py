@@ -0,0 +1,191 @@
+import time
+from typing import Optional
+
+from memorydb import AsyncDatabaseManager
+
+# 限流的範圍，檢查時由小到大；global 只有一個桶（owner_id 0）
+RATE_SCOPES = ('user', 'channel', 'server', 'global')
+
+
+class TokenBucket:
+    """容量 capacity、每秒補充 rate 個的令牌桶"""
+    __slots__ = ('capacity', 'rate', 'tokens', 'updated')
+
+    def __init__(self, capacity: float, rate: float, now: float) -> None:
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now: float) -> float:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def retry_after(self) -> float:
+        """距離下一個令牌的秒數"""
+        return (1 - self.tokens) / self.rate if self.rate > 0 else float('inf')
+
+
+class RateLimiter:
+    """依使用者、頻道、伺服器與全域限制會觸發 LLM 的訊息，並統計每日 token 用量
+
+    limits 為 {範圍: {'capacity': 桶容量, 'per_minute': 每分鐘補充數}}，daily_tokens 為 {範圍: 每日 token 上限}；
+    未設定或為 0 的範圍不限制。check() 只有在所有範圍都允許時才扣令牌，被拒絕時不影響其他範圍。
+    用量由 record() 累加在記憶體中，flush() 批次寫入 SQLite 的 llm_usage，重新啟動時以 load() 載入當天的用量。
+    """
+    def __init__(self, limits: Optional[dict] = None, daily_tokens: Optional[dict] = None,
+                 notify_interval: float = 60.0) -> None:
+        self.limits: dict[str, tuple[float, float]] = {}
+        self.daily_tokens: dict[str, int] = {}
+        self.notify_interval = notify_interval
+        self._buckets: dict[tuple[str, int], TokenBucket] = {}
+        self.day = time.strftime('%Y-%m-%d')
+        self._usage: dict[tuple[str, int], int] = {}          # (scope, owner_id) -> 當天 token 數
+        self._pending: dict[tuple[str, str, int], list] = {}  # (day, scope, owner_id) -> [請求數, 輸入 tokens, 輸出 tokens]
+        self._notified: dict[int, float] = {}
+        for scope, limit in (limits or {}).items():
+            self.set_limit(scope, limit.get('capacity', 0), limit.get('per_minute', 0))
+        for scope, tokens in (daily_tokens or {}).items():
+            self.set_daily_tokens(scope, tokens)
+        self.allowed = 0
+        self.rejected: dict[str, int] = {}
+
+    def set_limit(self, scope: str, capacity: float, per_minute: float) -> None:
+        if scope not in RATE_SCOPES:
+            raise ValueError(f'未知的範圍: {scope}')
+        if capacity > 0 and per_minute > 0:
+            self.limits[scope] = (float(capacity), per_minute / 60)
+        else:
+            self.limits.pop(scope, None)
+        # 既有的桶套用新的設定（令牌數不超過新容量），取消限制的範圍直接丟棄
+        for key, bucket in list(self._buckets.items()):
+            if key[0] != scope:
+                continue
+            if scope in self.limits:
+                bucket.capacity, bucket.rate = self.limits[scope]
+                bucket.tokens = min(bucket.tokens, bucket.capacity)
+            else:
+                del self._buckets[key]
+
+    def set_daily_tokens(self, scope: str, tokens: int) -> None:
+        if scope not in RATE_SCOPES:
+            raise ValueError(f'未知的範圍: {scope}')
+        if tokens > 0:
+            self.daily_tokens[scope] = int(tokens)
+        else:
+            self.daily_tokens.pop(scope, None)
+
+    def config(self) -> dict:
+        """目前的設定，格式與 Config.json 相同"""
+        return {
+            'rate_limits': {scope: {'capacity': capacity, 'per_minute': rate * 60}
+                            for scope, (capacity, rate) in self.limits.items()},
+            'daily_token_limits': dict(self.daily_tokens),
+        }
+
+    def _roll_day(self) -> None:
+        day = time.strftime('%Y-%m-%d')
+        if day != self.day:
+            self.day = day
+            self._usage.clear()
+
+    @staticmethod
+    def _owners(user_id: Optional[int], channel_id: Optional[int], server_id: Optional[int]) -> list:
+        owners = [('user', user_id), ('channel', channel_id), ('server', server_id or None), ('global', 0)]
+        return [(scope, owner_id) for scope, owner_id in owners if owner_id is not None]
+
+    def check(self, user_id: int, channel_id: int, server_id: Optional[int]) -> Optional[str]:
+        """允許時扣除令牌並回傳 None，否則回傳超過限制的範圍（不扣令牌）"""
+        self._roll_day()
+        owners = self._owners(user_id, channel_id, server_id)
+        for scope, owner_id in owners:
+            quota = self.daily_tokens.get(scope)
+            if quota and self._usage.get((scope, owner_id), 0) >= quota:
+                self.rejected[scope] = self.rejected.get(scope, 0) + 1
+                return scope
+        now = time.monotonic()
+        buckets = []
+        for scope, owner_id in owners:
+            limit = self.limits.get(scope)
+            if limit is None:
+                continue
+            bucket = self._buckets.get((scope, owner_id))
+            if bucket is None:
+                bucket = self._buckets[(scope, owner_id)] = TokenBucket(limit[0], limit[1], now)
+            if bucket.refill(now) < 1:
+                self.rejected[scope] = self.rejected.get(scope, 0) + 1
+                return scope
+            buckets.append(bucket)
+        for bucket in buckets:
+            bucket.tokens -= 1
+        self.allowed += 1
+        return None
+
+    def should_notify(self, user_id: int) -> bool:
+        """同一使用者每 notify_interval 秒只提示一次超過限制，其餘直接略過"""
+        now = time.monotonic()
+        if now - self._notified.get(user_id, float('-inf')) < self.notify_interval:
+            return False
+        self._notified[user_id] = now
+        return True
+
+    def retry_after(self, scope: str, user_id: int, channel_id: int, server_id: Optional[int]) -> Optional[float]:
+        """超過令牌桶限制時距離可再使用的秒數；超過每日用量時回傳 None"""
+        owner_id = dict(self._owners(user_id, channel_id, server_id)).get(scope)
+        bucket = self._buckets.get((scope, owner_id))
+        if scope in self.daily_tokens and self._usage.get((scope, owner_id), 0) >= self.daily_tokens[scope]:
+            return None
+        return bucket.retry_after() if bucket else 0.0
+
+    def record(self, user_id: Optional[int], channel_id: Optional[int], server_id: Optional[int],
+               usage: object) -> None:
+        """累加一次 LLM 呼叫的用量；usage 為回應的 usage_metadata（可為 None）"""
+        self._roll_day()
+        prompt_tokens = getattr(usage, 'prompt_token_count', None) or 0
+        total_tokens = getattr(usage, 'total_token_count', None)
+        # total 包含思考與工具的 token，沒有 total 時只算輸出
+        output_tokens = total_tokens - prompt_tokens if total_tokens else getattr(usage, 'candidates_token_count', None) or 0
+        for scope, owner_id in self._owners(user_id, channel_id, server_id):
+            self._usage[(scope, owner_id)] = self._usage.get((scope, owner_id), 0) + prompt_tokens + output_tokens
+            pending = self._pending.setdefault((self.day, scope, owner_id), [0, 0, 0])
+            pending[0] += 1
+            pending[1] += prompt_tokens
+            pending[2] += output_tokens
+
+    def usage(self, scope: str, owner_id: int) -> int:
+        self._roll_day()
+        return self._usage.get((scope, owner_id), 0)
+
+    def load(self, rows: list) -> None:
+        """載入當天已記錄的用量 [(scope, owner_id, requests, prompt_tokens, output_tokens)]，重新啟動後每日上限仍然有效"""
+        for scope, owner_id, _, prompt_tokens, output_tokens in rows:
+            key = (scope, owner_id)
+            self._usage[key] = self._usage.get(key, 0) + prompt_tokens + output_tokens
+
+    def take_pending(self) -> list:
+        """取出尚未寫入的用量 [(day, scope, owner_id, requests, prompt_tokens, output_tokens)]"""
+        pending, self._pending = self._pending, {}
+        return [(day, scope, owner_id, *counts) for (day, scope, owner_id), counts in pending.items()]
+
+    async def flush(self, db: AsyncDatabaseManager) -> None:
+        """把累積的用量寫入資料庫，並丟棄已補滿（閒置）的令牌桶"""
+        rows = self.take_pending()
+        if rows and not await db.add_llm_usage(rows):
+            for day, scope, owner_id, *counts in rows:  # 寫入失敗時保留，下次再寫
+                pending = self._pending.setdefault((day, scope, owner_id), [0, 0, 0])
+                for index, count in enumerate(counts):
+                    pending[index] += count
+        now = time.monotonic()
+        self._buckets = {key: bucket for key, bucket in self._buckets.items() if bucket.refill(now) < bucket.capacity}
+        self._notified = {user_id: at for user_id, at in self._notified.items() if now - at < self.notify_interval}
+
+    def stats(self) -> dict:
+        return {
+            **self.config(),
+            'buckets': len(self._buckets),
+            'allowed': self.allowed,
+            'rejected': dict(self.rejected),
+            'tokens_today': self._usage.get(('global', 0), 0),
+            'pending_writes': len(self._pending),
+        }
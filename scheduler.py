@@ -0,0 +1,259 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class ChannelDebouncer:
+    """依頻道合併短時間內連續到達的訊息，只觸發一次回覆
+
+    訊息在 window 秒內持續到達時會延後觸發；若生成途中又有新訊息，
+    尚未 commit 的生成會被取消，訊息併入下一批以合併後的歷史重新產生。
+    handler(key, items, commit) 在開始送出回覆前呼叫 commit()，之後就不會再被取消。
+    """
+    def __init__(self, window: float, handler: Callable[[Hashable, list, Callable[[], None]], Awaitable[None]]) -> None:
+        self.window = window
+        self.handler = handler
+        self._pending: dict[Hashable, list] = {}
+        self._timers: dict[Hashable, asyncio.Task] = {}
+        self._running: dict[Hashable, tuple[asyncio.Task, list, dict]] = {}
+        self.merged = 0
+        self.cancelled = 0
+
+    def submit(self, key: Hashable, item: Any) -> None:
+        pending = self._pending.setdefault(key, [])
+        if pending:
+            self.merged += 1
+        pending.append(item)
+        running = self._running.get(key)
+        if running and not running[2]['committed'] and not running[0].done():
+            task, items, _ = running
+            task.cancel()
+            self.cancelled += 1
+            self._pending[key] = items + self._pending[key]
+            del self._running[key]
+        timer = self._timers.get(key)
+        if timer:
+            timer.cancel()
+        self._timers[key] = asyncio.create_task(self._fire_later(key))
+
+    def discard(self, key: Hashable) -> None:
+        """放棄尚未觸發的訊息，並取消尚未 commit 的生成（例如已被 @提及 的回覆涵蓋）"""
+        timer = self._timers.pop(key, None)
+        if timer:
+            timer.cancel()
+        self._pending.pop(key, None)
+        running = self._running.get(key)
+        if running and not running[2]['committed'] and not running[0].done():
+            running[0].cancel()
+            self.cancelled += 1
+            del self._running[key]
+
+    async def _fire_later(self, key: Hashable) -> None:
+        await asyncio.sleep(self.window)
+        self._timers.pop(key, None)
+        items = self._pending.pop(key, [])
+        if not items:
+            return
+        state = {'committed': False}
+
+        def commit() -> None:
+            state['committed'] = True
+
+        task = asyncio.create_task(self.handler(key, items, commit))
+        self._running[key] = (task, items, state)
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"處理頻道 {key} 的合併訊息時發生錯誤: {e}")
+        finally:
+            if self._running.get(key, (None,))[0] is task:
+                del self._running[key]
+
+    def stats(self) -> dict:
+        return {
+            'pending_channels': len(self._pending),
+            'running': len(self._running),
+            'merged': self.merged,
+            'cancelled': self.cancelled,
+        }
+
+
+# 回覆的優先序（數字越小越優先）
+PRIORITY_DM = 0
+PRIORITY_MENTION = 1
+PRIORITY_AUTOCHAT = 2
+
+
+class ScheduledJob:
+    __slots__ = ('priority', 'factory', 'merge', 'enqueued', 'future', 'task', 'cancelled')
+
+    def __init__(self, priority: int, factory: Callable[[], Awaitable[Any]], merge: bool) -> None:
+        loop = asyncio.get_running_loop()
+        self.priority = priority
+        self.factory = factory
+        self.merge = merge
+        self.enqueued = loop.time()
+        self.future: asyncio.Future = loop.create_future()
+        self.task: asyncio.Task | None = None
+        self.cancelled = False
+
+    def finish(self, result: Any = None) -> None:
+        if not self.future.done():
+            self.future.set_result(result)
+
+
+class ReplyScheduler:
+    """回覆工作排程器
+
+    同一頻道的工作排成一列依序執行（不會交錯修改同一個對話），
+    全域只有固定數量的 worker，依頻道中最高的優先序（私訊 > 提及 > 自動聊天）挑選下一個頻道。
+    每個頻道與全體的排隊數量都有上限：可合併的工作會取代排在最後的同類工作，否則丟棄優先序最低的工作。
+    """
+    def __init__(self, workers: int = 4, max_queue_per_channel: int = 4, max_pending: int = 256) -> None:
+        self.workers = workers
+        self.max_queue_per_channel = max_queue_per_channel
+        self.max_pending = max_pending
+        self._queues: dict[Hashable, list[ScheduledJob]] = {}
+        self._ready: asyncio.PriorityQueue | None = None
+        self._queued: dict[Hashable, int] = {}  # 已在 ready 佇列中的頻道與其優先序
+        self._running: set = set()
+        self._tasks: list[asyncio.Task] = []
+        self._stopping = False
+        self._seq = 0
+        self.pending = 0
+        self.executed = 0
+        self.dropped = 0
+        self.merged = 0
+        self.wait_avg = 0.0
+        self.wait_max = 0.0
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        self._ready = asyncio.PriorityQueue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        """停止所有 worker（進行中的工作會被取消，排隊中的工作以 None 結束）"""
+        self._stopping = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for queue in self._queues.values():
+            for job in queue:
+                job.finish(None)
+        self._queues.clear()
+        self._queued.clear()
+        self.pending = 0
+        self._stopping = False
+
+    def submit(self, key: Hashable, priority: int, factory: Callable[[], Awaitable[Any]],
+               merge: bool = False) -> ScheduledJob | None:
+        """排入一個工作；佇列已滿而被丟棄時回傳 None"""
+        self.start()
+        job = ScheduledJob(priority, factory, merge)
+        queue = self._queues.setdefault(key, [])
+        if merge and queue and queue[-1].merge and queue[-1].priority == priority:
+            # 同類可合併的工作：新的取代排在最後的舊工作
+            queue[-1].finish(None)
+            queue[-1] = job
+            self.merged += 1
+        elif len(queue) >= self.max_queue_per_channel:
+            # 頻道佇列已滿：丟棄優先序最低的工作；新工作的優先序不比它高時直接丟棄新工作
+            victim = max(reversed(queue), key=lambda j: j.priority)
+            self.dropped += 1
+            if victim.priority <= priority:
+                return None
+            queue.remove(victim)
+            victim.finish(None)
+            queue.append(job)
+        elif self.pending >= self.max_pending and priority >= PRIORITY_AUTOCHAT:
+            # 全體過載時只保留私訊與提及
+            self.dropped += 1
+            return None
+        else:
+            queue.append(job)
+            self.pending += 1
+        self._mark_ready(key)
+        return job
+
+    async def run(self, key: Hashable, priority: int, factory: Callable[[], Awaitable[Any]], merge: bool = False) -> Any:
+        """排入工作並等待完成；等待的一方被取消時，工作也會從佇列移除或被取消"""
+        job = self.submit(key, priority, factory, merge)
+        if job is None:
+            return None
+        try:
+            return await job.future
+        except asyncio.CancelledError:
+            job.cancelled = True
+            if job.task:
+                job.task.cancel()
+            raise
+
+    def _mark_ready(self, key: Hashable) -> None:
+        queue = self._queues.get(key)
+        if not queue or key in self._running:
+            return
+        priority = min(job.priority for job in queue)
+        if key in self._queued and self._queued[key] <= priority:
+            return
+        self._queued[key] = priority
+        self._seq += 1
+        self._ready.put_nowait((priority, self._seq, key))
+
+    async def _worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            priority, _, key = await self._ready.get()
+            if self._queued.get(key) != priority:
+                continue  # 已被更高優先序的項目取代
+            del self._queued[key]
+            queue = self._queues.get(key)
+            if not queue:
+                self._queues.pop(key, None)
+                continue
+            job = queue.pop(0)
+            self.pending -= 1
+            if job.cancelled:
+                job.finish(None)
+                self._mark_ready(key)
+                continue
+            self._running.add(key)
+            wait = loop.time() - job.enqueued
+            self.wait_max = max(self.wait_max, wait)
+            self.wait_avg = wait if not self.executed else self.wait_avg * 0.9 + wait * 0.1
+            try:
+                job.task = asyncio.create_task(job.factory())
+                job.finish(await job.task)
+            except asyncio.CancelledError:
+                job.finish(None)
+                # worker 本身被停止時，等待中的工作也會一起被取消，因此要以 worker 的取消請求判斷
+                if self._stopping or asyncio.current_task().cancelling() or not job.task or not job.task.cancelled():
+                    raise
+            except Exception as e:
+                print(f"執行頻道 {key} 的回覆工作時發生錯誤: {e}")
+                job.finish(None)
+            finally:
+                self.executed += 1
+                self._running.discard(key)
+                if self._queues.get(key):
+                    self._mark_ready(key)
+                else:
+                    self._queues.pop(key, None)
+
+    def stats(self) -> dict:
+        depths = [len(queue) for queue in self._queues.values()]
+        return {
+            'workers': self.workers,
+            'busy': len(self._running),
+            'pending': self.pending,
+            'channels_waiting': len(self._queued),
+            'max_channel_depth': max(depths, default=0),
+            'wait_avg_s': round(self.wait_avg, 3),
+            'wait_max_s': round(self.wait_max, 3),
+            'executed': self.executed,
+            'merged': self.merged,
+            'dropped': self.dropped,
+        }
@@ -0,0 +1,58 @@
+import time
+from typing import Optional
+
+import discord
+
+
+class StreamingMessage:
+    """把串流產生的文字逐步顯示在 Discord 訊息上
+
+    第一段文字一到就送出訊息，之後最多每 edit_interval 秒編輯一次（避免觸發編輯的速率限制）；
+    目前訊息超過 max_length 時，前 max_length 個字元定稿，其餘內容接到新的訊息。
+    """
+    def __init__(self, channel: discord.abc.Messageable, max_length: int = 2000, edit_interval: float = 1.0) -> None:
+        self.channel = channel
+        self.max_length = max_length
+        self.edit_interval = edit_interval
+        self.text = ''
+        self.messages: list[discord.Message] = []
+        self._message: Optional[discord.Message] = None
+        self._current = ''  # 目前這則訊息應有的內容
+        self._shown = ''    # 目前這則訊息實際顯示的內容
+        self._last_edit = 0.0
+
+    @property
+    def started(self) -> bool:
+        return bool(self.messages)
+
+    async def feed(self, text: str) -> None:
+        if not text:
+            return
+        self.text += text
+        self._current += text
+        while len(self._current) > self.max_length:
+            head, self._current = self._current[:self.max_length], self._current[self.max_length:]
+            if head.strip():
+                await self._show(head)
+            self._message, self._shown = None, ''
+        if not self._current.strip():
+            return
+        if self._message is None or time.monotonic() - self._last_edit >= self.edit_interval:
+            await self._show(self._current)
+
+    async def finish(self) -> str:
+        """顯示剩餘的內容，回傳完整文字"""
+        if self._current.strip():
+            await self._show(self._current)
+        return self.text
+
+    async def _show(self, content: str) -> None:
+        if content == self._shown:
+            return
+        if self._message is None:
+            self._message = await self.channel.send(content)
+            self.messages.append(self._message)
+        else:
+            await self._message.edit(content=content)
+        self._shown = content
+        self._last_edit = time.monotonic()
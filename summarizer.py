@@ -0,0 +1,193 @@
+import time
+import asyncio
+from typing import Awaitable, Callable, Optional
+
+from memorydb import AsyncDatabaseManager
+
+
+def written(result: object) -> bool:
+    """DatabaseManager 的新增記憶方法成功時回傳「已新增…」，失敗時回傳錯誤訊息"""
+    return isinstance(result, str) and result.startswith('已新增')
+
+
+class RollingSummarizer:
+    """各頻道的滾動摘要
+
+    對話片段先寫入 SQLite 的 summary_segments（當機也不會遺失），頻道累積 max_segments 則或 max_chars 字後，
+    在背景把片段併入該頻道目前的摘要，並在同一個交易中刪除已併入的片段。
+    每次送給模型的只有「先前的摘要 + 一批有上限的片段」，記憶體中也只保留各頻道的計數。
+    summarize(previous, segments) 為實際產生摘要的函數，可替換成測試用的假模型。
+    """
+    def __init__(self, db: AsyncDatabaseManager, summarize: Callable[[str, list], Awaitable[str]],
+                 max_segments: int = 40, max_chars: int = 6000, max_summary_chars: int = 1500,
+                 retry_delay: float = 60.0, max_parallel: int = 4) -> None:
+        self.db = db
+        self.summarize = summarize
+        self.max_segments = max_segments
+        self.max_chars = max_chars
+        self.max_summary_chars = max_summary_chars
+        self.retry_delay = retry_delay
+        self._pending: dict[int, list] = {}  # channel_id -> [片段數, 字數]
+        self._folding: dict[int, asyncio.Task] = {}
+        self._retry_at: dict[int, float] = {}
+        self._semaphore = asyncio.Semaphore(max_parallel)  # 同時整理的頻道數
+        self.folds = 0
+        self.failures = 0
+
+    async def start(self) -> None:
+        """載入重新啟動前留下的片段計數，超過門檻的頻道立即整理"""
+        for channel_id, count, chars in await self.db.get_pending_summary_counts():
+            self._pending[channel_id] = [count, chars or 0]
+            self._maybe_schedule(channel_id)
+
+    async def add(self, channel_id: int, server_id: Optional[int], text: str) -> None:
+        await self.db.add_summary_segments([(channel_id, server_id, text, time.time())])
+        counts = self._pending.setdefault(channel_id, [0, 0])
+        counts[0] += 1
+        counts[1] += len(text)
+        self._maybe_schedule(channel_id)
+
+    def _maybe_schedule(self, channel_id: int) -> None:
+        count, chars = self._pending.get(channel_id, (0, 0))
+        if count < self.max_segments and chars < self.max_chars:
+            return
+        if time.monotonic() < self._retry_at.get(channel_id, 0):
+            return
+        self._schedule(channel_id)
+
+    def _schedule(self, channel_id: int) -> asyncio.Task:
+        # 同一頻道同時只有一個整理工作
+        task = self._folding.get(channel_id)
+        if task is None:
+            task = self._folding[channel_id] = asyncio.create_task(self._fold_in_background(channel_id))
+        return task
+
+    async def _fold_in_background(self, channel_id: int) -> None:
+        try:
+            async with self._semaphore:
+                await self.fold(channel_id)
+        except Exception as e:
+            print(f"整理頻道 {channel_id} 的摘要時發生錯誤: {e}")
+        finally:
+            self._folding.pop(channel_id, None)
+
+    async def fold(self, channel_id: int) -> bool:
+        """把頻道所有待整理的片段分批併入摘要；失敗時片段保留在資料庫，稍後重試"""
+        while True:
+            segments = await self.db.get_summary_segments(channel_id, self.max_segments)
+            if not segments:
+                return True
+            batch, chars = [], 0
+            for segment in segments:
+                if batch and chars + len(segment[2]) > self.max_chars:
+                    break
+                batch.append(segment)
+                chars += len(segment[2])
+            previous = await self.db.get_rolling_summary(channel_id) or ''
+            try:
+                summary = await self.summarize(previous, [content for _, _, content in batch])
+            except Exception as e:
+                print(f"產生頻道 {channel_id} 的摘要時發生錯誤: {e}")
+                summary = None
+            if not summary or not await self.db.save_rolling_summary(
+                    channel_id, batch[-1][1], summary.strip()[:self.max_summary_chars], batch[-1][0]):
+                self.failures += 1
+                self._retry_at[channel_id] = time.monotonic() + self.retry_delay
+                return False
+            self.folds += 1
+            counts = self._pending.get(channel_id)
+            if counts:
+                counts[0] = max(counts[0] - len(batch), 0)
+                counts[1] = max(counts[1] - chars, 0)
+                if not counts[0]:
+                    del self._pending[channel_id]
+
+    async def fold_all(self) -> None:
+        """整理所有頻道剩餘的片段（不論是否達到門檻），等待進行中的整理完成"""
+        channel_ids = [channel_id for channel_id, _, _ in await self.db.get_pending_summary_counts()]
+        await asyncio.gather(*(self._schedule(channel_id) for channel_id in channel_ids))
+
+    def stats(self) -> dict:
+        return {
+            'pending_channels': len(self._pending),
+            'pending_segments': sum(count for count, _ in self._pending.values()),
+            'folding': len(self._folding),
+            'folds': self.folds,
+            'failures': self.failures,
+        }
+
+
+class SummaryPipeline:
+    """每晚的階層式（map-reduce）摘要
+
+    map：各頻道剩餘的片段併入頻道摘要（各頻道並行，數量受 RollingSummarizer 的 max_parallel 限制）；
+    reduce：同一伺服器的頻道摘要整合成伺服器摘要，再把所有伺服器摘要與私訊摘要整合成全域摘要。
+    每一層以 fan_in 個為一組並行整合，總耗時取決於層數而不是總量。
+    結果分別寫入 channel_memories、server_memories 與 core_memories，之後才刪除已整理的頻道摘要。
+    reduce(label, texts) 為實際整合摘要的函數，可替換成測試用的假模型。
+    """
+    def __init__(self, db: AsyncDatabaseManager, summarizer: RollingSummarizer,
+                 reduce: Callable[[str, list], Awaitable[str]], max_parallel: int = 4, fan_in: int = 8) -> None:
+        self.db = db
+        self.summarizer = summarizer
+        self.reduce = reduce
+        self.fan_in = max(fan_in, 2)
+        self._semaphore = asyncio.Semaphore(max_parallel)
+        self.last_run: Optional[dict] = None
+
+    async def _reduce_one(self, label: str, texts: list) -> str:
+        if len(texts) == 1:
+            return texts[0]  # 只有一份時不需要再整合
+        async with self._semaphore:
+            return (await self.reduce(label, texts)).strip()
+
+    async def _reduce_tree(self, label: str, texts: list) -> str:
+        while len(texts) > 1:
+            groups = [texts[i:i + self.fan_in] for i in range(0, len(texts), self.fan_in)]
+            texts = list(await asyncio.gather(*(self._reduce_one(label, group) for group in groups)))
+        return texts[0]
+
+    async def run(self, date: Optional[str] = None) -> Optional[str]:
+        """執行整個流程，回傳全域摘要；沒有需要整理的對話時回傳 None"""
+        started = time.monotonic()
+        date = date or time.strftime('%Y/%m/%d')
+        await self.summarizer.fold_all()
+        summaries = await self.db.get_rolling_summaries()
+        if not summaries:
+            self.last_run = {'channels': 0, 'servers': 0, 'elapsed_ms': (time.monotonic() - started) * 1000}
+            return None
+
+        by_server: dict[int, list] = {}
+        for channel_id, server_id, summary, _ in summaries:
+            by_server.setdefault(server_id or 0, []).append((channel_id, summary))
+        servers = [server_id for server_id in by_server if server_id]  # 私訊（伺服器 0）不整合成伺服器摘要
+        server_summaries = await asyncio.gather(*(
+            self._reduce_tree(f'伺服器 {server_id}', [summary for _, summary in by_server[server_id]]) for server_id in servers))
+        dm_summaries = [summary for _, summary in by_server.get(0, [])]
+        global_summary = await self._reduce_tree('全部伺服器與私訊', list(server_summaries) + dm_summaries)
+
+        channels = [(channel_id, server_id) for server_id in servers for channel_id, _ in by_server[server_id]]
+        results = await asyncio.gather(
+            *(self.db.add_channel_memory(channel_id, f'{date} 摘要: {summary}')
+              for server_id in servers for channel_id, summary in by_server[server_id]),
+            *(self.db.add_server_memory(server_id, f'{date} 摘要: {summary}')
+              for server_id, summary in zip(servers, server_summaries)),
+            self.db.add_core_memory(f'{date} 摘要: {global_summary}'))
+        # 資料庫錯誤以字串回傳；只刪除內容已寫入記憶的頻道摘要，其餘留到下次再整理
+        channel_ok = {channel_id: written(result) for (channel_id, _), result in zip(channels, results)}
+        server_ok = {server_id: written(result) for server_id, result in zip(servers, results[len(channels):])}
+        core_ok = written(results[-1])
+        cleared = [(channel_id, updated_at) for channel_id, server_id, _, updated_at in summaries
+                   if (channel_ok.get(channel_id) and server_ok.get(server_id) if server_id else core_ok)]
+        failed = [result for result in results if not written(result)]
+        for result in failed:
+            print(f"寫入摘要記憶失敗: {result}")
+        await self.db.clear_rolling_summaries(cleared)
+        self.last_run = {
+            'channels': len(summaries),
+            'servers': len(servers),
+            'kept': len(summaries) - len(cleared),
+            'failed_writes': len(failed),
+            'elapsed_ms': (time.monotonic() - started) * 1000,
+        }
+        return global_summary
@@ -0,0 +1,61 @@
+import asyncio
+from typing import Any, Awaitable, Callable
+
+from google.genai import types
+
+
+class ToolRegistry:
+    """模型可呼叫的函數登錄表
+
+    以 register 登錄函數宣告與對應的 handler(context, **args)；dispatch 並行執行同一回合中的所有函數呼叫，
+    回傳可一次送回模型的 function_response。visible 的函數（例如寫入記憶）其結果也會顯示給使用者。
+    """
+    def __init__(self) -> None:
+        self._tools: dict[str, tuple[dict, Callable[..., Awaitable[Any]], bool]] = {}
+        self.calls = 0
+        self.errors = 0
+
+    def register(self, declaration: dict, visible: bool = False) -> Callable:
+        def decorator(handler: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+            self._tools[declaration['name']] = (declaration, handler, visible)
+            return handler
+        return decorator
+
+    def declarations(self) -> list:
+        return [declaration for declaration, _, _ in self._tools.values()]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._tools
+
+    async def _call(self, context: Any, function_call: types.FunctionCall) -> tuple[Any, bool]:
+        tool = self._tools.get(function_call.name)
+        if tool is None:
+            self.errors += 1
+            return {'error': f'未知的函數: {function_call.name}'}, False
+        _, handler, visible = tool
+        try:
+            return await handler(context, **(function_call.args or {})), visible
+        except Exception as e:
+            self.errors += 1
+            print(f"執行函數 {function_call.name} 時發生錯誤: {e}")
+            return {'error': str(e)}, False
+
+    async def dispatch(self, context: Any, function_calls: list) -> tuple[list, list]:
+        """並行執行 function_calls，回傳 (function_response parts, 要顯示給使用者的結果文字)"""
+        self.calls += len(function_calls)
+        results = await asyncio.gather(*(self._call(context, function_call) for function_call in function_calls))
+        parts = []
+        visible_texts = []
+        for function_call, (result, visible) in zip(function_calls, results):
+            print(f"Function call: {function_call.name}({function_call.args}) -> {result}")
+            parts.append(types.Part(function_response=types.FunctionResponse(
+                id=function_call.id,
+                name=function_call.name,
+                response=result if isinstance(result, dict) else {'result': result},
+            )))
+            if visible and isinstance(result, str):
+                visible_texts.append(result)
+        return parts, visible_texts
+
+    def stats(self) -> dict:
+        return {'tools': list(self._tools), 'calls': self.calls, 'errors': self.errors}
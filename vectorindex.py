@@ -0,0 +1,210 @@
+import re
+import zlib
+import queue
+import threading
+from typing import Optional, Any
+
+import numpy as np
+
+from memorydb import DatabaseManager
+
+
+class HashingEmbedder:
+    """離線、可重現的字元 n-gram 雜湊向量（預設 embedder，不需要網路）"""
+    def __init__(self, dim: int = 512, ngrams: tuple = (1, 2)) -> None:
+        self.dim = dim
+        self.ngrams = ngrams
+        self.name = f'hash-{dim}-{"".join(str(n) for n in ngrams)}'
+
+    def embed(self, texts: list) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            text = re.sub(r'\s+', ' ', (text or '').lower())
+            for n in self.ngrams:
+                for i in range(len(text) - n + 1):
+                    # crc32 在每次執行都相同（內建 hash() 會隨機化），最高位元決定正負號
+                    h = zlib.crc32(text[i:i + n].encode('utf-8'))
+                    vectors[row, h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        return normalize(vectors)
+
+
+class GeminiEmbedder:
+    """使用 Gemini embedding API 的 embedder（需要網路與 API 金鑰）"""
+    def __init__(self, client: Any, model: str = 'gemini-embedding-001', dim: int = 768) -> None:
+        self.client = client
+        self.model = model
+        self.dim = dim
+        self.name = f'gemini-{model}-{dim}'
+
+    def embed(self, texts: list) -> np.ndarray:
+        from google.genai import types
+        response = self.client.models.embed_content(
+            model=self.model,
+            contents=list(texts),
+            config=types.EmbedContentConfig(output_dimensionality=self.dim),
+        )
+        return normalize(np.array([e.values for e in response.embeddings], dtype=np.float32))
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def pack(vector: np.ndarray) -> bytes:
+    return np.asarray(vector, dtype='<f4').tobytes()
+
+
+def unpack(blob: bytes) -> np.ndarray:
+    return np.frombuffer(blob, dtype='<f4')
+
+
+class VectorIndex:
+    """記憶的記憶體內向量索引，依 (scope, owner_id) 分區
+
+    分區在第一次查詢時才從 memory_embeddings 載入，缺少向量的舊記憶會在載入時分批補算並存回；
+    新增記憶時 DatabaseManager 的記憶回呼只把記憶放進佇列（不在寫入執行緒呼叫 embedder），
+    由背景執行緒分批計算向量、寫入資料庫並增量更新已載入的分區，不需要整體重建。
+    """
+    def __init__(self, db: DatabaseManager, embedder: Optional[Any] = None, batch_size: int = 100) -> None:
+        self.db = db
+        self.embedder = embedder or HashingEmbedder()
+        self.batch_size = batch_size  # 每次 embed 的筆數上限（Gemini 每個請求最多 100 筆）
+        self._partitions: dict[tuple[str, int], tuple[np.ndarray, np.ndarray]] = {}
+        # 載入中的分區：[進行中的載入數, 載入期間新增的 (memory_id, vector), 是否有新記憶計算失敗]，發布分區前併入
+        self._loading: dict[tuple[str, int], list] = {}
+        self._lock = threading.Lock()
+        self._queue: queue.Queue = queue.Queue()
+        self.failures = 0
+        self._thread = threading.Thread(target=self._run, name='vector-embed', daemon=True)
+        self._thread.start()
+        db.add_memory_listener(self.on_memory_added)
+
+    def _load(self, scope: str, owner_id: int) -> tuple[np.ndarray, np.ndarray]:
+        key = (scope, owner_id)
+        with self._lock:
+            if key in self._partitions:
+                return self._partitions[key]
+            self._loading.setdefault(key, [0, [], False])[0] += 1  # 必須在讀取資料庫之前標記
+        try:
+            return self._load_partition(scope, owner_id)
+        finally:
+            with self._lock:
+                loading = self._loading[key]
+                loading[0] -= 1
+                if not loading[0]:
+                    del self._loading[key]
+
+    def _load_partition(self, scope: str, owner_id: int) -> tuple[np.ndarray, np.ndarray]:
+        key = (scope, owner_id)
+        stored, missing = self.db.load_embeddings(scope, owner_id, self.embedder.name)
+        ids = [memory_id for memory_id, _ in stored]
+        vectors = [unpack(blob) for _, blob in stored]
+        complete = True
+        for i in range(0, len(missing), self.batch_size):
+            batch = missing[i:i + self.batch_size]
+            try:
+                embedded = self.embedder.embed([content for _, content in batch])
+            except Exception as e:
+                # 補算失敗：先用已有的向量，分區不快取，下次查詢時再補
+                print(f"計算{scope}記憶 {owner_id} 的向量時發生錯誤: {e}")
+                self.failures += 1
+                complete = False
+                break
+            self.db.save_embeddings(scope, self.embedder.name,
+                                    [(memory_id, owner_id, pack(v)) for (memory_id, _), v in zip(batch, embedded)])
+            ids += [memory_id for memory_id, _ in batch]
+            vectors += list(embedded)
+        partition = (np.array(ids, dtype=np.int64),
+                     np.vstack(vectors) if vectors else np.zeros((0, self.embedder.dim), dtype=np.float32))
+        with self._lock:
+            if key in self._partitions:
+                return self._partitions[key]
+            if not complete or self._loading[key][2]:
+                return partition  # 缺少部分向量時不快取，下次查詢重新載入
+            # 讀取資料庫之後才新增的記憶由 _add 暫存在這裡，發布前補上
+            known = set(ids)
+            added = [(memory_id, vector) for memory_id, vector in self._loading[key][1] if memory_id not in known]
+            if added:
+                partition = (np.append(partition[0], [memory_id for memory_id, _ in added]),
+                             np.vstack([partition[1]] + [vector for _, vector in added]))
+            self._partitions[key] = partition
+            return partition
+
+    def on_memory_added(self, scope: str, owner_id: Optional[int], memory_id: int, content: str) -> None:
+        """記憶回呼（在寫入執行緒呼叫）：只排入佇列"""
+        self._queue.put((scope, owner_id or 0, memory_id, content))
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._add(batch)
+            except Exception as e:
+                # 向量沒有存下：作廢相關的已載入分區，下次載入時會當作缺少向量的記憶補算
+                print(f"計算 {len(batch)} 筆新記憶的向量時發生錯誤: {e}")
+                self.failures += 1
+                with self._lock:
+                    for scope, owner_id, _, _ in batch:
+                        self._partitions.pop((scope, owner_id), None)
+                        if (scope, owner_id) in self._loading:
+                            self._loading[(scope, owner_id)][2] = True
+
+    def _add(self, batch: list) -> None:
+        vectors = self.embedder.embed([content for _, _, _, content in batch])
+        by_scope: dict[str, list] = {}
+        for (scope, owner_id, memory_id, _), vector in zip(batch, vectors):
+            by_scope.setdefault(scope, []).append((memory_id, owner_id, pack(vector)))
+        for scope, rows in by_scope.items():
+            self.db.save_embeddings(scope, self.embedder.name, rows)
+        with self._lock:
+            for (scope, owner_id, memory_id, _), vector in zip(batch, vectors):
+                # 尚未載入的分區下次載入時就會讀到這筆；正在載入的分區暫存起來；載入時已補算過的不重複加入
+                partition = self._partitions.get((scope, owner_id))
+                if partition is not None and memory_id not in partition[0]:
+                    ids, matrix = partition
+                    self._partitions[(scope, owner_id)] = (np.append(ids, memory_id), np.vstack([matrix, vector]))
+                elif partition is None and (scope, owner_id) in self._loading:
+                    self._loading[(scope, owner_id)][1].append((memory_id, vector))
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def search(self, query: str, partitions: list, k: int = 5, exclude: Optional[set] = None,
+               min_score: float = 0.1) -> dict:
+        """在多個分區中以 cosine 相似度找出最接近 query 的 k 筆記憶
+
+        partitions 為 [(scope, owner_id)]；回傳 {scope: [{'id', 'owner_id', 'content', 'timestamp', 'score'}]}，
+        exclude 為要略過的 (scope, memory_id)。
+        """
+        if not query or k <= 0 or not partitions:
+            return {}
+        q = self.embedder.embed([query])[0]
+        exclude = exclude or set()
+        candidates = []
+        for scope, owner_id in dict.fromkeys(partitions):
+            ids, matrix = self._load(scope, owner_id or 0)
+            if not len(ids):
+                continue
+            scores = matrix @ q
+            count = min(k + len(exclude), len(ids))
+            top = np.argpartition(-scores, count - 1)[:count]
+            candidates += [(float(scores[i]), scope, int(ids[i])) for i in top
+                           if scores[i] >= min_score and (scope, int(ids[i])) not in exclude]
+        candidates.sort(reverse=True)
+        by_scope: dict[str, dict[int, float]] = {}
+        for score, scope, memory_id in candidates[:k]:
+            by_scope.setdefault(scope, {})[memory_id] = score
+        results = {}
+        for scope, scores in by_scope.items():
+            memories = self.db.get_memories_by_ids(scope, list(scores))
+            for memory in memories:
+                memory['score'] = scores[memory['id']]
+            results[scope] = memories
+        return results